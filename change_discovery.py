@@ -0,0 +1,123 @@
+import configparser
+import os
+
+
+PAGE_SIZE = 200
+
+DEFAULT_MAX_CHANGES = 5000
+DEFAULT_MAX_FILE_SIZE = 1024 * 1024
+
+DEFAULT_EXCLUDED_DIRS = [
+    "bin",
+    "obj",
+    "node_modules",
+    "packages",
+    ".vs",
+    ".idea",
+    "TestResults",
+]
+
+BINARY_EXTENSIONS = {
+    ".dll",
+    ".exe",
+    ".pdb",
+    ".so",
+    ".dylib",
+    ".nupkg",
+    ".zip",
+    ".gz",
+    ".tar",
+    ".7z",
+    ".png",
+    ".jpg",
+    ".jpeg",
+    ".gif",
+    ".ico",
+    ".bmp",
+    ".pdf",
+    ".woff",
+    ".woff2",
+    ".ttf",
+    ".mp3",
+    ".mp4",
+    ".bin",
+    ".cache",
+}
+
+
+def read_change_config():
+
+    config = configparser.ConfigParser()
+
+    config.read("config.ini")
+
+    section = config["CHANGES"] if "CHANGES" in config else {}
+
+    excluded_dirs = section.get("EXCLUDED_DIRS")
+
+    return {
+        "max_changes": int(section.get("MAX_CHANGES", DEFAULT_MAX_CHANGES)),
+        "max_file_size": int(section.get("MAX_FILE_SIZE", DEFAULT_MAX_FILE_SIZE)),
+        "excluded_dirs": (
+            set(DEFAULT_EXCLUDED_DIRS)
+            if excluded_dirs is None
+            else {d.strip() for d in excluded_dirs.split(",") if d.strip()}
+        ),
+    }
+
+
+def is_listable(working_dir, path, max_file_size):
+
+    if os.path.splitext(path)[1].lower() in BINARY_EXTENSIONS:
+        return False
+
+    try:
+        return os.path.getsize(os.path.join(working_dir, path)) <= max_file_size
+    except OSError:
+        # deleted files are still changes worth listing
+        return True
+
+
+def iter_changes(git_access, settings):
+
+    excluded_dirs = settings["excluded_dirs"]
+
+    for path in git_access.iter_modified_files():
+        if excluded_dirs.intersection(path.split("/")[:-1]):
+            continue
+        if is_listable(git_access.working_dir, path, settings["max_file_size"]):
+            yield path
+
+    for path in git_access.iter_untracked_files(excluded_dirs):
+        if is_listable(git_access.working_dir, path, settings["max_file_size"]):
+            yield path
+
+
+class ChangeStream:
+    def __init__(self, git_access, settings=None):
+        self.settings = settings or read_change_config()
+        self.changes = iter_changes(git_access, self.settings)
+        self.count = 0
+        self.done = False
+        self.truncated = False
+
+    def next_page(self, page_size=PAGE_SIZE):
+
+        page = []
+
+        while len(page) < page_size and not self.done:
+            try:
+                change = next(self.changes)
+            except StopIteration:
+                self.done = True
+                break
+
+            if self.count >= self.settings["max_changes"]:
+                self.truncated = True
+                self.done = True
+                break
+
+            page.append(change)
+            self.count += 1
+
+        return page
@@ -0,0 +1,234 @@
+import configparser
+import math
+import os
+import threading
+
+from PyQt6.QtCore import pyqtSignal
+
+from file_index import FileIndex
+from git_access import get_git_access
+from run_poller import PooledTask
+from symbol_index import IDENTIFIER_PATTERN, TYPE_DECLARATION_PATTERN, read_code
+
+
+INDEX_VERSION = 1
+
+DEFAULT_MAX_CONTEXT_FILES = 3
+DEFAULT_CONTEXT_TOKEN_BUDGET = 6000
+
+# BM25 term frequency saturation and document length normalisation
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# a file declaring a type the pair uses (its base class, an interface, a
+# fixture) is worth far more than one that merely mentions it
+DECLARATION_BOOST = 3.0
+
+
+def read_context_config():
+
+    config = configparser.ConfigParser()
+
+    config.read("config.ini")
+
+    if "CONTEXT" not in config:
+        return True, DEFAULT_MAX_CONTEXT_FILES, DEFAULT_CONTEXT_TOKEN_BUDGET
+
+    section = config["CONTEXT"]
+
+    return (
+        section.getboolean("ENABLED", True),
+        section.getint("MAX_FILES", DEFAULT_MAX_CONTEXT_FILES),
+        section.getint("TOKEN_BUDGET", DEFAULT_CONTEXT_TOKEN_BUDGET),
+    )
+
+
+def index_terms(file_path):
+
+    code = read_code(file_path)
+
+    terms = {}
+    for identifier in IDENTIFIER_PATTERN.findall(code):
+        terms[identifier] = terms.get(identifier, 0) + 1
+
+    return terms, sorted(set(TYPE_DECLARATION_PATTERN.findall(code)))
+
+
+class ContextIndex(FileIndex):
+
+    version = INDEX_VERSION
+    label = "Context"
+
+    def __init__(self, git_access, index_path):
+        # identifier -> {file: count}
+        self.postings = {}
+        # type -> files declaring it
+        self.declarations = {}
+        self.total_length = 0
+
+        # file -> {"mtime", "size", "length", "terms": {identifier: count},
+        # "declares": [type]}
+        super().__init__(git_access, index_path)
+
+    def read_entry(self, file_path):
+
+        terms, declares = index_terms(file_path)
+
+        return {"length": sum(terms.values()), "terms": terms, "declares": declares}
+
+    def add_postings(self, file_path, entry):
+
+        for identifier, count in entry["terms"].items():
+            self.postings.setdefault(identifier, {})[file_path] = count
+
+        for type_name in entry["declares"]:
+            self.declarations.setdefault(type_name, set()).add(file_path)
+
+        self.total_length += entry["length"]
+
+    def remove_postings(self, file_path, entry):
+
+        for identifier in entry["terms"]:
+            postings = self.postings.get(identifier)
+            if postings is None:
+                continue
+            postings.pop(file_path, None)
+            if not postings:
+                del self.postings[identifier]
+
+        for type_name in entry["declares"]:
+            declaring_files = self.declarations.get(type_name)
+            if declaring_files is None:
+                continue
+            declaring_files.discard(file_path)
+            if not declaring_files:
+                del self.declarations[type_name]
+
+        self.total_length -= entry["length"]
+
+    def idf(self, document_count):
+
+        return math.log(
+            1 + (len(self.files) - document_count + 0.5) / (document_count + 0.5)
+        )
+
+    def rank(self, query_terms, exclude=()):
+
+        if not self.files:
+            return []
+
+        average_length = max(self.total_length / len(self.files), 1)
+
+        scores = {}
+        for identifier in query_terms:
+            postings = self.postings.get(identifier, {})
+            if not postings:
+                continue
+
+            idf = self.idf(len(postings))
+
+            for file_path, count in postings.items():
+                length_norm = (
+                    1
+                    - BM25_B
+                    + BM25_B * (self.files[file_path]["length"] / average_length)
+                )
+                scores[file_path] = scores.get(file_path, 0) + idf * (
+                    count * (BM25_K1 + 1) / (count + BM25_K1 * length_norm)
+                )
+
+            for file_path in self.declarations.get(identifier, ()):
+                scores[file_path] = scores.get(file_path, 0) + DECLARATION_BOOST * idf
+
+        for file_path in exclude:
+            scores.pop(file_path, None)
+
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+    def select(self, pair_paths, max_files, token_budget):
+
+        # the query is what the pair uses but does not declare itself, so the
+        # ranking favours the files the pair builds on over its other callers
+        query_terms = set()
+        pair_types = set()
+        for file_path in pair_paths:
+            terms, declares = index_terms(file_path)
+            query_terms.update(terms)
+            pair_types.update(declares)
+        query_terms -= pair_types
+
+        selected = []
+        used_tokens = 0
+
+        for file_path, score in self.rank(
+            query_terms, [os.path.normpath(path) for path in pair_paths]
+        ):
+            if len(selected) >= max_files:
+                break
+
+            file_tokens = self.files[file_path]["size"] // 4
+            if used_tokens + file_tokens > token_budget:
+                continue
+
+            print(f"Context file {os.path.basename(file_path)} (score {score:.1f})")
+            selected.append(file_path)
+            used_tokens += file_tokens
+
+        return selected
+
+
+context_indexes = {}
+
+# the index is built and queried from pool threads, one selection at a time
+context_lock = threading.Lock()
+
+
+def get_context_index(repo):
+
+    context_index = context_indexes.get(repo.working_dir)
+
+    if context_index is None:
+        context_index = ContextIndex(
+            get_git_access(repo),
+            os.path.join(repo.git_dir, "unit_test_generator", "context_index.json"),
+        )
+        context_indexes[repo.working_dir] = context_index
+
+    context_index.update()
+
+    return context_index
+
+
+def select_context_files(repo, initial_file_path, test_file_path):
+
+    enabled, max_files, token_budget = read_context_config()
+
+    if not enabled or max_files <= 0:
+        return []
+
+    with context_lock:
+        return get_context_index(repo).select(
+            [initial_file_path, test_file_path], max_files, token_budget
+        )
+
+
+class ContextSelectionTask(PooledTask):
+    context_selected = pyqtSignal(list)
+
+    def __init__(self, repo, initial_file_path, test_file_path):
+        super().__init__()
+        self.repo = repo
+        self.initial_file_path = initial_file_path
+        self.test_file_path = test_file_path
+
+    def run(self):
+        # the first build walks the whole repository, which would block the
+        # window it was started from
+        try:
+            context_file_paths = select_context_files(
+                self.repo, self.initial_file_path, self.test_file_path
+            )
+        except Exception as e:
+            print(f"Failed to select context files: {e}")
+            context_file_paths = []
+        self.context_selected.emit(context_file_paths)
@@ -0,0 +1,203 @@
+import atexit
+import configparser
+import cProfile
+import functools
+import inspect
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+from PyQt6.QtCore import QTimer
+
+
+DEFAULT_STALL_THRESHOLD_MS = 200
+DEFAULT_PROFILE_DIR = "profiles"
+
+STACK_DEPTH = 12
+MAX_REPORTED_STACKS = 3
+
+settings = {"watchdog": False, "profile": False, "profile_dir": DEFAULT_PROFILE_DIR}
+
+# names of the decorated slots currently running on the GUI thread
+running_slots = []
+
+stage_profiles = {}
+profile_lock = threading.Lock()
+
+
+def read_diagnostics_config():
+
+    config = configparser.ConfigParser()
+
+    config.read("config.ini")
+
+    if "DIAGNOSTICS" not in config:
+        return False, DEFAULT_STALL_THRESHOLD_MS, False, DEFAULT_PROFILE_DIR
+
+    section = config["DIAGNOSTICS"]
+
+    return (
+        section.getboolean("STALL_WATCHDOG", False),
+        section.getint("STALL_THRESHOLD_MS", DEFAULT_STALL_THRESHOLD_MS),
+        section.getboolean("PROFILE_STAGES", False),
+        section.get("PROFILE_DIR", DEFAULT_PROFILE_DIR),
+    )
+
+
+def format_stack(frame):
+
+    return "".join(traceback.format_list(traceback.extract_stack(frame)[-STACK_DEPTH:]))
+
+
+class StallWatchdog:
+    def __init__(self, threshold_ms):
+        self.threshold = threshold_ms / 1000
+        self.heartbeat_interval = max(threshold_ms // 4, 10)
+        self.main_thread_id = threading.main_thread().ident
+        self.last_beat = time.monotonic()
+        self.timer = None
+        self.thread = None
+
+    def start(self):
+
+        # the timer only fires while the event loop is free, so a gap between
+        # beats is the time the GUI thread spent blocked
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.beat)
+        self.timer.start(self.heartbeat_interval)
+
+        self.thread = threading.Thread(
+            target=self.watch, name="stall-watchdog", daemon=True
+        )
+        self.thread.start()
+
+    def beat(self):
+
+        self.last_beat = time.monotonic()
+
+    def watch(self):
+
+        stall_start = None
+        samples = Counter()
+        slots = Counter()
+
+        while True:
+            time.sleep(self.heartbeat_interval / 1000)
+
+            last_beat = self.last_beat
+
+            if time.monotonic() - last_beat > self.threshold:
+                if stall_start is None:
+                    stall_start = last_beat
+                frame = sys._current_frames().get(self.main_thread_id)
+                if frame is not None:
+                    samples[format_stack(frame)] += 1
+                running = list(running_slots)
+                slots[running[-1] if running else "unknown slot"] += 1
+                continue
+
+            if stall_start is not None:
+                self.report(last_beat - stall_start, samples, slots)
+                stall_start = None
+                samples = Counter()
+                slots = Counter()
+
+    def report(self, duration, samples, slots):
+
+        print(
+            f"GUI thread stalled for {duration * 1000:.0f} ms in "
+            f"{slots.most_common(1)[0][0]} ({sum(samples.values())} samples)"
+        )
+
+        for stack, count in samples.most_common(MAX_REPORTED_STACKS):
+            print(f"  {count} samples at:\n{stack}")
+
+
+def profile_stage(stage, function, *args):
+
+    # one profiler runs at a time, nested slots count towards the outer stage
+    if not profile_lock.acquire(blocking=False):
+        return function(*args)
+
+    try:
+        profile = stage_profiles.setdefault(stage, cProfile.Profile())
+        return profile.runcall(function, *args)
+    finally:
+        profile_lock.release()
+
+
+def dump_profiles():
+
+    if not stage_profiles:
+        return
+
+    os.makedirs(settings["profile_dir"], exist_ok=True)
+
+    timestamp = time.strftime("%Y%m%d-%H%M%S")
+
+    for stage, profile in stage_profiles.items():
+        path = os.path.join(settings["profile_dir"], f"{stage}-{timestamp}.prof")
+        profile.dump_stats(path)
+        print(f"Wrote {stage} profile to {path}")
+
+
+def diagnosed(stage):
+
+    def decorate(function):
+
+        parameters = inspect.signature(function).parameters.values()
+        takes_any = any(p.kind == p.VAR_POSITIONAL for p in parameters)
+        positional_count = len(
+            [
+                p
+                for p in parameters
+                if p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD)
+            ]
+        )
+
+        @functools.wraps(function)
+        def wrapper(*args):
+
+            # signals pass all of their arguments, the slot may take fewer
+            if not takes_any:
+                args = args[:positional_count]
+
+            if not settings["watchdog"] and not settings["profile"]:
+                return function(*args)
+
+            running_slots.append(function.__qualname__)
+            try:
+                if settings["profile"]:
+                    return profile_stage(stage, function, *args)
+                return function(*args)
+            finally:
+                running_slots.pop()
+
+        return wrapper
+
+    return decorate
+
+
+def start_diagnostics():
+
+    watchdog, threshold_ms, profile, profile_dir = read_diagnostics_config()
+
+    settings["watchdog"] = watchdog
+    settings["profile"] = profile
+    settings["profile_dir"] = profile_dir
+
+    if profile:
+        atexit.register(dump_profiles)
+
+    if not watchdog:
+        return None
+
+    print(f"Watching for GUI stalls longer than {threshold_ms} ms")
+
+    stall_watchdog = StallWatchdog(threshold_ms)
+    stall_watchdog.start()
+
+    return stall_watchdog
@@ -0,0 +1,113 @@
+import json
+import os
+from abc import ABC, abstractmethod
+
+from change_discovery import read_change_config
+from git_access import iter_working_files
+
+
+class FileIndex(ABC):
+
+    # subclasses set these and say what is kept for each file
+    version = 1
+    label = "File"
+
+    def __init__(self, git_access, index_path, subdir=""):
+        self.git_access = git_access
+        self.working_dir = git_access.working_dir
+        self.index_path = index_path
+        self.subdir = subdir
+
+        # file -> {"mtime", "size", ...whatever read_entry returns}
+        self.files = {}
+
+        self.load()
+
+    def load(self):
+
+        try:
+            with open(self.index_path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if data.get("version") != self.version:
+            return
+
+        self.files = data["files"]
+
+        for file_path, entry in self.files.items():
+            self.add_postings(file_path, entry)
+
+    def save(self):
+
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+
+        with open(self.index_path, "w") as f:
+            json.dump({"version": self.version, "files": self.files}, f)
+
+    @abstractmethod
+    def read_entry(self, file_path):
+        pass
+
+    @abstractmethod
+    def add_postings(self, file_path, entry):
+        pass
+
+    @abstractmethod
+    def remove_postings(self, file_path, entry):
+        pass
+
+    def iter_files(self):
+
+        # the same directories are skipped as when listing changes, and
+        # ignored files are left out like git leaves them out
+        for path in iter_working_files(
+            self.working_dir,
+            self.git_access.ignore_rules(),
+            read_change_config()["excluded_dirs"],
+            self.subdir,
+        ):
+            if path.endswith(".cs"):
+                yield os.path.normpath(os.path.join(self.working_dir, path))
+
+    def update(self):
+
+        seen = set()
+        changed = 0
+
+        for file_path in self.iter_files():
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+
+            seen.add(file_path)
+
+            entry = self.files.get(file_path)
+            if (
+                entry is not None
+                and entry["mtime"] == stat.st_mtime
+                and entry["size"] == stat.st_size
+            ):
+                continue
+
+            if entry is not None:
+                self.remove_postings(file_path, entry)
+
+            entry = self.read_entry(file_path)
+            entry["mtime"] = stat.st_mtime
+            entry["size"] = stat.st_size
+
+            self.files[file_path] = entry
+            self.add_postings(file_path, entry)
+            changed += 1
+
+        for file_path in list(self.files):
+            if file_path not in seen:
+                self.remove_postings(file_path, self.files.pop(file_path))
+                changed += 1
+
+        if changed:
+            print(f"{self.label} index updated {changed} of {len(self.files)} files")
+            self.save()
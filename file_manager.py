@@ -0,0 +1,308 @@
+import configparser
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from openai import NotFoundError, OpenAI
+
+from run_poller import worker_pool
+from session_journal import session_journal
+
+
+FILE_LEDGER = "uploaded_files.db"
+
+# ledgers written before uploads were tracked in SQLite
+LEGACY_FILE_LEDGER = "uploaded_files.json"
+
+# files of sessions whose process cannot be checked are reclaimed after this
+ORPHAN_AGE_SECONDS = 12 * 60 * 60
+
+SESSION_ID = uuid.uuid4().hex
+
+FILE_WORKER_COUNT = 4
+
+# uploads are waited on from the GUI thread, so they get their own pool
+# instead of queueing behind generations holding the shared worker pool
+file_pool = ThreadPoolExecutor(
+    max_workers=FILE_WORKER_COUNT, thread_name_prefix="files"
+)
+
+
+def process_alive(pid):
+
+    # os.kill terminates the process on Windows, so liveness is unknown there
+    if os.name == "nt":
+        return None
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+class FileLedger:
+    def __init__(self, ledger_path=FILE_LEDGER, legacy_path=LEGACY_FILE_LEDGER):
+        self.ledger_path = ledger_path
+        self.legacy_path = legacy_path
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def connect(self):
+
+        if self.connection is not None:
+            return self.connection
+
+        # the app and any number of queue workers upload files, so the ledger
+        # lives in SQLite rather than in a file each process overwrites
+        self.connection = sqlite3.connect(
+            self.ledger_path, check_same_thread=False, timeout=30
+        )
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                id TEXT PRIMARY KEY,
+                session TEXT,
+                pid INTEGER,
+                path TEXT,
+                created REAL
+            )
+            """
+        )
+
+        self.import_legacy_ledger()
+
+        return self.connection
+
+    def import_legacy_ledger(self):
+
+        try:
+            with open(self.legacy_path, "r") as f:
+                ledger = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO files VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        file_id,
+                        entry["session"],
+                        entry["pid"],
+                        entry["path"],
+                        entry["created"],
+                    )
+                    for file_id, entry in ledger.items()
+                ],
+            )
+
+        try:
+            os.remove(self.legacy_path)
+        except OSError:
+            pass
+
+    def execute(self, statement, parameters=()):
+
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                return connection.execute(statement, parameters).fetchall()
+
+    def add(self, entries):
+
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (
+                            file_id,
+                            entry["session"],
+                            entry["pid"],
+                            entry["path"],
+                            entry["created"],
+                        )
+                        for file_id, entry in entries.items()
+                    ],
+                )
+
+    def remove(self, file_ids):
+
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                connection.executemany(
+                    "DELETE FROM files WHERE id = ?",
+                    [(file_id,) for file_id in file_ids],
+                )
+
+    def entries(self):
+
+        return {row["id"]: dict(row) for row in self.execute("SELECT * FROM files")}
+
+
+file_ledger = FileLedger()
+
+
+class FileManager:
+    def __init__(self, client, ledger=file_ledger):
+        self.client = client
+        self.ledger = ledger
+
+    def upload_file(self, file_path):
+
+        start_time = time.time()
+
+        with open(file_path, "rb") as f:
+            uploaded_file = self.client.files.create(file=f, purpose="assistants")
+
+        print(
+            f"{os.path.basename(file_path)} uploaded in "
+            f"{time.time() - start_time} seconds"
+        )
+
+        return uploaded_file
+
+    def upload(self, file_paths):
+
+        futures = [file_pool.submit(self.upload_file, path) for path in file_paths]
+
+        uploaded_files = []
+        errors = []
+        for file_path, future in zip(file_paths, futures):
+            try:
+                uploaded_files.append((future.result(), file_path))
+            except Exception as e:
+                errors.append(e)
+
+        # files that did upload are recorded even if another one failed, so
+        # the garbage collector can still reclaim them
+        self.ledger.add(
+            {
+                uploaded_file.id: {
+                    "session": SESSION_ID,
+                    "pid": os.getpid(),
+                    "path": file_path,
+                    "created": time.time(),
+                }
+                for uploaded_file, file_path in uploaded_files
+            }
+        )
+
+        if errors:
+            self.delete([uploaded_file.id for uploaded_file, _ in uploaded_files])
+            raise errors[0]
+
+        return [uploaded_file for uploaded_file, _ in uploaded_files]
+
+    def delete_file(self, file_id):
+
+        try:
+            self.client.files.delete(file_id)
+            print(f"Deleted file: {file_id}")
+        except NotFoundError:
+            print(f"File already deleted: {file_id}")
+
+    def delete(self, file_ids):
+
+        futures = [file_pool.submit(self.delete_file, file_id) for file_id in file_ids]
+
+        deleted = []
+        errors = []
+        for file_id, future in zip(file_ids, futures):
+            try:
+                future.result()
+                deleted.append(file_id)
+            except Exception as e:
+                errors.append(e)
+
+        self.ledger.remove(deleted)
+
+        if errors:
+            raise errors[0]
+
+    def file_exists(self, file_id):
+
+        try:
+            self.client.files.retrieve(file_id)
+        except NotFoundError:
+            return False
+
+        return True
+
+    def missing_files(self, file_ids):
+
+        futures = [file_pool.submit(self.file_exists, file_id) for file_id in file_ids]
+
+        return [
+            file_id for file_id, future in zip(file_ids, futures) if not future.result()
+        ]
+
+    def is_orphan(self, entry, now):
+
+        alive = process_alive(entry["pid"])
+
+        if alive is None:
+            return now - entry["created"] > ORPHAN_AGE_SECONDS
+
+        return not alive
+
+    def collect_orphans(self):
+
+        now = time.time()
+
+        ledger = self.ledger.entries()
+
+        # files of journaled sessions are kept until the session is resumed
+        # or discarded
+        resumable_files = session_journal.file_ids()
+
+        orphans = [
+            file_id
+            for file_id, entry in ledger.items()
+            if entry["session"] != SESSION_ID
+            and file_id not in resumable_files
+            and self.is_orphan(entry, now)
+        ]
+
+        if not orphans:
+            return
+
+        print(f"Reclaiming {len(orphans)} files left by previous sessions")
+
+        # this already runs on the worker pool, so files are deleted in turn
+        # rather than waiting on further pool tasks
+        reclaimed = []
+        for file_id in orphans:
+            try:
+                self.delete_file(file_id)
+                reclaimed.append(file_id)
+            except Exception as e:
+                print(f"Failed to reclaim file {file_id}: {e}")
+
+        self.ledger.remove(reclaimed)
+
+
+def start_orphan_collection():
+
+    config = configparser.ConfigParser()
+
+    config.read("config.ini")
+
+    if "OPENAI" not in config or "API_KEY" not in config["OPENAI"]:
+        return
+
+    file_manager = FileManager(OpenAI(api_key=config["OPENAI"]["API_KEY"]))
+
+    worker_pool.submit(file_manager.collect_orphans)
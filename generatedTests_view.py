@@ -10,6 +10,7 @@ from PyQt6.QtWidgets import (
     QListWidget,
     QPushButton,
     QStyledItemDelegate,
+    QTabWidget,
 )
 from PyQt6.QtGui import (
     QMovie,
@@ -18,45 +19,123 @@ from PyQt6.QtGui import (
     QColor,
     QFont,
     QTextCursor,
+    QTextDocument,
 )
-from PyQt6.QtCore import Qt, QSize, pyqtSignal, QThread
+from PyQt6.QtCore import Qt, QSize, QTimer
 from openai import OpenAI
-import time
-from collections import deque
+from collections import OrderedDict, deque
 import re
 import os
 import sys
 
+from diagnostics import diagnosed
+from file_manager import FileManager
+from test_generator import TestGenerator
+from usage_stats import (
+    BUDGET_STOP,
+    BUDGET_THROTTLE,
+    read_budget_config,
+    usage_ledger,
+)
+
+
+MAX_OPEN_DOCUMENTS = 8
 
-class CodeView(QWidget):
-    def __init__(self, code):
+
+class CodeViewer(QWidget):
+    def __init__(self, max_documents=MAX_OPEN_DOCUMENTS):
         super().__init__()
 
+        self.setWindowTitle("Generated Test Code")
         self.resize(800, 600)
 
+        self.max_documents = max_documents
+
+        # test name -> (code, highlighted document), least recently used first
+        self.documents = OrderedDict()
+
         self.copy_button = QPushButton("Copy to Clipboard")
         self.copy_button.clicked.connect(self.copy_to_clipboard)
         self.copy_button.setFixedHeight(40)
 
-        self.code_edit = QTextEdit()
-        self.code_edit.setReadOnly(True)
-
-        code = code.replace("```csharp", "").replace("```", "").strip()
-
-        self.code_edit.setPlainText(code)
+        self.tabs = QTabWidget()
+        self.tabs.setTabsClosable(True)
+        self.tabs.tabCloseRequested.connect(self.close_tab)
 
         layout = QVBoxLayout()
         layout.addWidget(self.copy_button)
-        layout.addWidget(self.code_edit)
+        layout.addWidget(self.tabs)
         self.setLayout(layout)
 
-        self.format_code()
+    def open_code(self, test_name, code):
+
+        code = code.replace("```csharp", "").replace("```", "").strip()
+
+        if test_name in self.documents and self.documents[test_name][0] == code:
+            self.documents.move_to_end(test_name)
+            document = self.documents[test_name][1]
+        else:
+            self.drop_document(test_name)
+
+            document = QTextDocument(self)
+            document.setPlainText(code)
+            self.format_code(document)
+
+            self.documents[test_name] = (code, document)
+            self.evict_documents()
+
+        index = self.tab_index(test_name)
+
+        if index == -1:
+            code_edit = QTextEdit()
+            code_edit.setReadOnly(True)
+            code_edit.setDocument(document)
+            code_edit.test_name = test_name
+            index = self.tabs.addTab(code_edit, test_name)
+
+        self.tabs.setCurrentIndex(index)
+
+        self.show()
+        self.raise_()
+        self.activateWindow()
+
+    def tab_index(self, test_name):
+
+        for index in range(self.tabs.count()):
+            if self.tabs.widget(index).test_name == test_name:
+                return index
+
+        return -1
+
+    def close_tab(self, index):
+
+        # the document stays cached so reopening the test skips highlighting
+        code_edit = self.tabs.widget(index)
+        self.tabs.removeTab(index)
+        code_edit.deleteLater()
+
+    def drop_document(self, test_name):
+
+        index = self.tab_index(test_name)
+        if index != -1:
+            self.close_tab(index)
+
+        if test_name in self.documents:
+            self.documents.pop(test_name)[1].deleteLater()
+
+    def evict_documents(self):
+
+        while len(self.documents) > self.max_documents:
+            self.drop_document(next(iter(self.documents)))
 
     def copy_to_clipboard(self):
 
-        QGuiApplication.clipboard().setText(self.code_edit.toPlainText())
+        code_edit = self.tabs.currentWidget()
+
+        if code_edit is not None:
+            QGuiApplication.clipboard().setText(code_edit.toPlainText())
 
-    def format_code(self):
+    def format_code(self, document):
 
         using_format = QTextCharFormat()
         using_format.setForeground(QColor("red"))
@@ -66,23 +145,21 @@ class CodeView(QWidget):
         fact_theory_format.setForeground(QColor("yellow"))
         fact_theory_format.setFontWeight(QFont.Weight.Bold)
 
-        self.highlight_pattern(r"\busing\b", using_format)
+        self.highlight_pattern(document, r"\busing\b", using_format)
 
-        self.highlight_pattern(r"\[Fact\]", fact_theory_format)
-        self.highlight_pattern(r"\[Theory\]", fact_theory_format)
+        self.highlight_pattern(document, r"\[Fact\]", fact_theory_format)
+        self.highlight_pattern(document, r"\[Theory\]", fact_theory_format)
 
-    def highlight_pattern(self, pattern, format):
+    def highlight_pattern(self, document, pattern, format):
 
         regex = re.compile(pattern)
 
-        document = self.code_edit.document()
-
         for match in regex.finditer(document.toPlainText()):
 
             start = match.start()
             end = match.end()
 
-            cursor = self.code_edit.textCursor()
+            cursor = QTextCursor(document)
 
             cursor.setPosition(start, QTextCursor.MoveMode.MoveAnchor)
             cursor.setPosition(end, QTextCursor.MoveMode.KeepAnchor)
@@ -97,60 +174,6 @@ class CustomDelegate(QStyledItemDelegate):
         return size
 
 
-class RunStatusThread(QThread):
-    status_updated = pyqtSignal(str)
-
-    def __init__(self, client, thread_id, run_id, test_name):
-        super().__init__()
-        self.client = client
-        self.thread_id = thread_id
-        self.run_id = run_id
-        self.test_name = test_name
-
-    def run(self):
-        delay = 1
-        run = self.client.beta.threads.runs.retrieve(
-            thread_id=self.thread_id, run_id=self.run_id
-        )
-        while run.status in ["queued", "in_progress", "cancelling"]:
-            time.sleep(delay)
-            run = self.client.beta.threads.runs.retrieve(
-                thread_id=self.thread_id, run_id=self.run_id
-            )
-            self.status_updated.emit(run.status)
-            delay = min(delay * 2, 15)
-
-
-class ChatAPIThread(QThread):
-    response_received = pyqtSignal(object)
-
-    def __init__(self, client, content, test_name):
-        super().__init__()
-        self.client = client
-        self.content = content
-        self.test_name = test_name
-
-    def run(self):
-        chat_response = self.client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You need to extract only the unit test code from the content and send only the unit test code back and nothing else.",
-                },
-                {
-                    "role": "user",
-                    "content": f"""return only the unit test code from the following content, do not include namespace, classes or anything but the unit test definition:
-                    
-                    {self.content}""",
-                },
-            ],
-            temperature=1,
-            max_tokens=1000,
-        )
-        self.response_received.emit(chat_response)
-
-
 class GeneratedTestsView(QWidget):
     def generate_tests(self):
 
@@ -160,95 +183,107 @@ class GeneratedTestsView(QWidget):
         self.loading_label.show()
         self.loading_movie.start()
 
-        self.client = OpenAI(api_key=self.api_key)
+        if self.test_generator is None:
+            self.test_generator = TestGenerator(
+                OpenAI(api_key=self.api_key),
+                self.initial_file,
+                self.test_file,
+                self.formatted_changes,
+                self.initial_file_path,
+                self.test_file_path,
+                context_files=self.context_files,
+            )
 
-        self.generate_next_test()
+        self.test_generator.set_session_tests(self.selected_tests)
 
-    def generate_next_test(self):
+        self.test_generator.status_updated.connect(self.run_status_updated)
+        self.test_generator.test_generated.connect(self.test_generated)
+        self.test_generator.test_failed.connect(self.test_failed)
 
-        if self.tests_queue:
+        self.generate_next_test()
 
-            test = self.tests_queue.popleft()
-            print(f"Generating test: {test['test-name']}")
+    @diagnosed("tests")
+    def generate_next_test(self):
 
-            assistant = self.client.beta.assistants.retrieve(
-                "asst_GpfjUzQuQhp1DwF86auMjxMY"
-            )
+        while self.tests_queue:
 
-            thread = self.client.beta.threads.create()
+            test = self.tests_queue[0]
 
-            message_content = f"""Here are sections of the code that have been modified in the current commit:
+            test_code = self.test_generator.result(test)
 
-    \\`\\`\\`
-    {self.formatted_changes}
-    \\`\\`\\`
+            if test_code is not None:
+                self.tests_queue.popleft()
+                self.add_test_item(test["test-name"], test_code)
+                continue
 
-    Your task is to write the following unit test (either with Fact or Theory as you see fit in the xUnit framework):
+            self.current_test_name = test["test-name"]
 
-    {test["test-description"]}
+            # speculative results are already in flight, just wait for them
+            if self.test_generator.is_pending(test):
+                return
 
-    Reference the TestsBase.cs file and especially the {self.test_file_name} file to ensure the same conventions, approach and style is used to write this single unit test that integrates well into the {self.test_file_name} file. If at any point you are unsure of what needs to be written in any part of the unit test, provide INLINE comments for guidance in order to avoid false and confusing code. Again if you are unsure, provide inline comments.
-"""
+            budget = usage_ledger.check_budget()
 
-            thread_message = self.client.beta.threads.messages.create(
-                thread_id=thread.id,
-                role="user",
-                content=message_content,
-                file_ids=[self.initial_file.id, self.test_file.id],
-            )
+            if budget == BUDGET_STOP:
+                QMessageBox.warning(
+                    self,
+                    "Token Budget",
+                    f"The token budget has been used up, {len(self.tests_queue)} "
+                    f"queued tests were not generated.\n\n{usage_ledger.summary()}",
+                )
+                self.tests_queue.clear()
+                break
+
+            if budget == BUDGET_THROTTLE and not self.throttled:
+                print("Token budget is running low, throttling generation")
+                self.throttled = True
+                QTimer.singleShot(
+                    read_budget_config()["throttle_seconds"] * 1000,
+                    self.generate_next_test,
+                )
+                return
 
-            run = self.client.beta.threads.runs.create(
-                thread_id=thread.id, assistant_id=assistant.id
+            self.throttled = False
+            self.test_generator.generate_batch(
+                self.test_generator.next_batch(list(self.tests_queue))
             )
+            return
 
-            print(f"Run status after creation: {run.status}")
-
-            self.run_status_thread = RunStatusThread(
-                self.client, thread.id, run.id, test["test-name"]
-            )
-            self.run_status_thread.status_updated.connect(self.run_status_updated)
-            self.run_status_thread.start()
+        self.loading_movie.stop()
+        self.loading_label.hide()
 
     def run_status_updated(self, status):
         print(f"Run status during polling: {status}")
 
-        if status not in ["queued", "in_progress", "cancelling"]:
+    @diagnosed("tests")
+    def test_generated(self, test_name, test_code):
 
-            if status == "completed":
-                messages = self.client.beta.threads.messages.list(
-                    thread_id=self.run_status_thread.thread_id
-                )
+        if self.tests_queue and test_name == self.current_test_name:
+            self.tests_queue.popleft()
+            self.add_test_item(test_name, test_code)
+            self.generate_next_test()
 
-                last_message = None
-                for message in reversed(messages.data):
-                    if message.role == "assistant":
-                        last_message = message
-                        break
-
-                if last_message is not None:
-                    for content_block in last_message.content:
-                        pass
-
-                    self.chat_api_thread = ChatAPIThread(
-                        self.client,
-                        content_block.text.value,
-                        self.run_status_thread.test_name,
-                    )
-                    self.chat_api_thread.response_received.connect(
-                        self.chat_api_response_received
-                    )
-                    self.chat_api_thread.start()
-            else:
-                print(status)
+    @diagnosed("tests")
+    def test_failed(self, test_name, error):
 
-    def chat_api_response_received(self, chat_response):
+        if not self.tests_queue or test_name != self.current_test_name:
+            return
 
-        self.loading_movie.stop()
-        self.loading_label.hide()
+        self.tests_queue.popleft()
 
-        test_code = chat_response.choices[0].message.content
+        QMessageBox.warning(
+            self,
+            "Error",
+            f"An error occurred while generating {test_name}: {error}",
+        )
+
+        self.generate_next_test()
+
+    def usage_recorded(self):
+
+        self.usage_label.setText(usage_ledger.summary())
 
-        test_name = self.sender().test_name
+    def add_test_item(self, test_name, test_code):
 
         item = QListWidgetItem(test_name)
         item.setData(Qt.ItemDataRole.UserRole, test_code)
@@ -263,29 +298,42 @@ class GeneratedTestsView(QWidget):
 
         self.unit_test_list.show()
 
-        self.generate_next_test()
-
+    @diagnosed("tests")
     def handle_item_double_clicked(self, item):
 
         test_code = item.data(Qt.ItemDataRole.UserRole)
 
-        code_view = CodeView(test_code)
-        code_view.show()
+        if self.code_viewer is None:
+            self.code_viewer = CodeViewer()
 
-        self.code_views.append(code_view)
+        self.code_viewer.open_code(item.text(), test_code)
 
     def __init__(
-        self, selected_tests, initial_file, test_file, formatted_changes, test_file_name
+        self,
+        selected_tests,
+        initial_file,
+        test_file,
+        formatted_changes,
+        initial_file_path,
+        test_file_path,
+        test_generator=None,
+        context_files=(),
     ):
         super().__init__()
 
-        self.code_views = []
+        self.code_viewer = None
 
         self.selected_tests = selected_tests
         self.initial_file = initial_file
         self.test_file = test_file
         self.formatted_changes = formatted_changes
-        self.test_file_name = test_file_name
+        self.initial_file_path = initial_file_path
+        self.test_file_path = test_file_path
+        self.context_files = list(context_files)
+        self.test_file_name = os.path.basename(test_file_path)
+        self.test_generator = test_generator
+        self.current_test_name = None
+        self.throttled = False
 
         self.setWindowTitle("Generated Tests")
         self.resize(800, 600)
@@ -331,6 +379,11 @@ class GeneratedTestsView(QWidget):
         self.unit_test_list.hide()
         self.layout.addWidget(self.unit_test_list)
 
+        self.usage_label = QLabel(usage_ledger.summary())
+        self.layout.addWidget(self.usage_label)
+        usage_ledger.usage_recorded.connect(self.usage_recorded)
+        self.usage_connected = True
+
         self.loading_label.show()
         self.loading_movie.start()
 
@@ -360,59 +413,32 @@ class GeneratedTestsView(QWidget):
 
         self.client = OpenAI(api_key=self.api_key)
 
-        self.files = self.client.files.list().data
+        self.file_manager = FileManager(self.client)
+
+        missing_files = self.file_manager.missing_files(
+            [file.id for file in [self.initial_file, self.test_file] if file]
+        )
 
-        if self.initial_file and not any(
-            file.id == self.initial_file.id for file in self.files
-        ):
+        if self.initial_file and self.initial_file.id in missing_files:
             QMessageBox.warning(self, "Error", "Initial file not found")
 
-        if self.test_file and not any(
-            file.id == self.test_file.id for file in self.files
-        ):
+        if self.test_file and self.test_file.id in missing_files:
             QMessageBox.warning(self, "Error", "Test file not found")
 
         self.tests_queue = deque(self.selected_tests)
         self.generate_tests()
 
     def delete_files(self):
-        client = OpenAI(api_key=self.api_key)
 
         try:
 
-            time.sleep(1)
-
-            files = client.files.list().data
-
-            if self.initial_file and any(
-                file.id == self.initial_file.id for file in files
-            ):
-                try:
-
-                    client.files.delete(self.initial_file.id)
-                    print(f"Deleted initial file: {self.initial_file.id}")
-                except Exception as e:
-                    if "Not Found" in str(e):
-                        print("Initial file already deleted")
-                    else:
-                        raise
-                self.initial_file = None
-
-            time.sleep(3)
-
-            files = client.files.list().data
-
-            if self.test_file and any(file.id == self.test_file.id for file in files):
-                try:
-
-                    client.files.delete(self.test_file.id)
-                    print(f"Deleted test file: {self.test_file.id}")
-                except Exception as e:
-                    if "Not Found" in str(e):
-                        print("Test file already deleted")
-                    else:
-                        raise
-                self.test_file = None
+            self.file_manager.delete(
+                [file.id for file in [self.initial_file, self.test_file] if file]
+                + [file.id for _, file in self.context_files]
+            )
+            self.initial_file = None
+            self.test_file = None
+            self.context_files = []
 
         except Exception as e:
             QMessageBox.warning(
@@ -422,5 +448,24 @@ class GeneratedTestsView(QWidget):
         self.close()
 
     def closeEvent(self, event):
+        # the ledger outlives the window, which must stop listening to it
+        if self.usage_connected:
+            usage_ledger.usage_recorded.disconnect(self.usage_recorded)
+            self.usage_connected = False
+
+        # unfinished runs can be left running and picked up on the next start
+        if self.tests_queue and self.initial_file is not None:
+            answer = QMessageBox.question(
+                self,
+                "Unfinished Tests",
+                f"{len(self.tests_queue)} tests have not been generated yet. "
+                "Keep them to resume the next time the app starts?",
+            )
+            if answer == QMessageBox.StandardButton.Yes:
+                self.tests_queue.clear()
+                event.accept()
+                return
+
+        self.test_generator.cancel_all()
         self.delete_files()
         event.accept()
@@ -0,0 +1,444 @@
+import configparser
+import time
+
+from PyQt6.QtCore import pyqtSignal
+
+from job_queue import (
+    JOB_CANCELLED,
+    JOB_DONE,
+    JOB_FAILED,
+    JOB_LEASED,
+    JOB_QUEUED,
+    JobQueue,
+    read_queue_config,
+)
+from model_router import model_router
+from prompts import build_file_context
+from run_poller import PENDING_RUN_STATUSES, PooledTask, run_poller
+from usage_stats import usage_ledger
+
+IDEAS_STAGE = "ideas"
+TESTS_STAGE = "tests"
+
+IDEAS_ASSISTANT_ID = "asst_XW9b1pA7W2aExEWEFnp69xVq"
+TESTS_ASSISTANT_ID = "asst_GpfjUzQuQhp1DwF86auMjxMY"
+
+DEFAULT_CHAT_MODEL = "gpt-4-turbo-preview"
+DEFAULT_CHAT_MAX_TOKENS = 2000
+
+# The assistants keep their instructions server side, the chat backend has to
+# send an equivalent system prompt with every request.
+STAGE_INSTRUCTIONS = {
+    IDEAS_STAGE: "You are an expert C# developer who writes xUnit tests. Given modified code, the source file and its existing test file, you suggest the new unit tests that need to be written, giving each one a name and a description.",
+    TESTS_STAGE: "You are an expert C# developer who writes xUnit tests. Given modified code, the source file and its existing test file, you write the requested unit test following the conventions already used in the test file.",
+}
+
+
+class GenerationError(Exception):
+    pass
+
+
+class AssistantsBackend:
+
+    name = "assistants"
+
+    polls_runs = True
+    extracts_code = False
+
+    def __init__(self, client, stage, assistant_id):
+        self.client = client
+        self.stage = stage
+        self.assistant_id = assistant_id
+
+    def submit(self, message_content, file_paths, file_ids, route=None):
+
+        assistant = self.client.beta.assistants.retrieve(self.assistant_id)
+
+        thread = self.client.beta.threads.create()
+
+        self.client.beta.threads.messages.create(
+            thread_id=thread.id,
+            role="user",
+            content=message_content,
+            attachments=[
+                {"file_id": file_id, "tools": [{"type": "file_search"}]}
+                for file_id in file_ids
+            ],
+        )
+
+        # a routed run overrides the model and output cap the assistant
+        # was created with
+        run_options = {}
+        if route is not None:
+            run_options = {
+                "model": route.model,
+                "max_completion_tokens": route.max_tokens,
+                "temperature": route.temperature,
+            }
+
+        run = self.client.beta.threads.runs.create(
+            thread_id=thread.id, assistant_id=assistant.id, **run_options
+        )
+
+        print(f"Run status after creation: {run.status}")
+
+        return run
+
+    def retrieve_run(self, thread_id, run_id):
+
+        return self.client.beta.threads.runs.retrieve(
+            thread_id=thread_id, run_id=run_id
+        )
+
+    def cancel_run(self, thread_id, run_id):
+
+        self.client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+
+    def collect(self, run):
+
+        if run.status != "completed":
+            raise GenerationError(f"Run finished with status {run.status}")
+
+        messages = self.client.beta.threads.messages.list(thread_id=run.thread_id)
+
+        for message in reversed(messages.data):
+            if message.role == "assistant":
+                return message.content[-1].text.value, getattr(run, "usage", None)
+
+        raise GenerationError("Run completed without an assistant message")
+
+    def generate(
+        self,
+        message_content,
+        file_paths,
+        file_ids,
+        on_status=None,
+        should_stop=None,
+        route=None,
+    ):
+
+        run = self.submit(message_content, file_paths, file_ids, route)
+
+        delay = 1
+        while run.status in PENDING_RUN_STATUSES:
+            if should_stop and should_stop():
+                self.cancel_run(run.thread_id, run.id)
+                raise GenerationError("Run cancelled")
+            time.sleep(delay)
+            run = self.retrieve_run(run.thread_id, run.id)
+            if on_status:
+                on_status(run.status)
+            delay = min(delay * 2, 15)
+
+        return self.collect(run)
+
+
+class ChatCompletionsBackend:
+
+    name = "chat"
+
+    polls_runs = False
+    extracts_code = False
+
+    def __init__(self, client, stage, model, max_tokens, instructions):
+        self.client = client
+        self.stage = stage
+        self.model = model
+        self.max_tokens = max_tokens
+        self.instructions = instructions
+
+    def generate(
+        self,
+        message_content,
+        file_paths,
+        file_ids,
+        on_status=None,
+        should_stop=None,
+        route=None,
+    ):
+
+        # Chat completions cannot see uploaded files, so the same files the
+        # assistant would retrieve are inlined ahead of the prompt instead.
+        file_context = build_file_context(file_paths)
+
+        if on_status:
+            on_status("in_progress")
+
+        messages = [
+            {"role": "system", "content": self.instructions},
+            {
+                "role": "user",
+                "content": f"{file_context}\n\n{message_content}",
+            },
+        ]
+
+        if route is not None:
+            chat_response = model_router.create_chat_completion(
+                self.client, route, messages
+            )
+        else:
+            chat_response = self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                max_tokens=self.max_tokens,
+            )
+
+        if should_stop and should_stop():
+            raise GenerationError("Request cancelled")
+
+        if on_status:
+            on_status("completed")
+
+        return chat_response.choices[0].message.content, chat_response.usage
+
+
+class QueuedRun:
+    def __init__(self, thread_id, job):
+        self.thread_id = thread_id
+        self.id = str(job["id"])
+        self.status = JOB_STATUSES[job["status"]]
+        self.job = job
+        self.usage = None
+
+
+# queue job statuses in the run statuses the poller understands
+JOB_STATUSES = {
+    JOB_QUEUED: "queued",
+    JOB_LEASED: "in_progress",
+    JOB_DONE: "completed",
+    JOB_FAILED: "failed",
+    JOB_CANCELLED: "cancelled",
+}
+
+
+class JobQueueBackend:
+
+    name = "queue"
+
+    # workers run the whole pipeline, so jobs come back as finished test code
+    polls_runs = True
+    extracts_code = True
+
+    def __init__(self, stage, job_queue, pair=None, test=None):
+        self.stage = stage
+        self.job_queue = job_queue
+        self.pair = pair
+        self.test = test
+
+    def for_test(self, pair, test):
+
+        # a job carries one test, which the worker needs to extract its code
+        return JobQueueBackend(self.stage, self.job_queue, pair, test)
+
+    def submit(self, message_content, file_paths, file_ids, route=None):
+
+        # workers route their own requests
+        job_id = self.job_queue.enqueue(
+            self.pair, message_content, file_paths, self.test
+        )
+
+        print(f"Queued job {job_id} in {self.job_queue.queue_path}")
+
+        return self.retrieve_run(self.job_queue.queue_path, job_id)
+
+    def retrieve_run(self, thread_id, run_id):
+
+        job = self.job_queue.job(int(run_id))
+
+        if job is None:
+            raise GenerationError(f"Job {run_id} is missing from the queue")
+
+        return QueuedRun(thread_id, job)
+
+    def cancel_run(self, thread_id, run_id):
+
+        self.job_queue.cancel(int(run_id))
+
+    def collect(self, run):
+
+        if run.status != "completed":
+            raise GenerationError(
+                f"Job finished with status {run.status}: {run.job['error']}"
+            )
+
+        return run.job["result"], None
+
+
+def run_backend(client, stage, backend_name, thread_id):
+
+    # journaled runs are resumed or cancelled through the backend that
+    # submitted them, whatever the configuration says now
+    if backend_name == JobQueueBackend.name:
+        queue_config = read_queue_config()
+        return JobQueueBackend(
+            stage,
+            JobQueue(thread_id, queue_config["max_attempts"], queue_config["shared"]),
+        )
+
+    return AssistantsBackend(client, stage, TESTS_ASSISTANT_ID)
+
+
+def create_backend(client, stage, backend_name=None):
+
+    config = configparser.ConfigParser()
+
+    config.read("config.ini")
+
+    section = config["GENERATION"] if "GENERATION" in config else {}
+
+    if backend_name is None:
+        backend_name = section.get(f"{stage.upper()}_BACKEND", AssistantsBackend.name)
+
+    if backend_name == JobQueueBackend.name and stage != TESTS_STAGE:
+        print(f"The job queue only runs {TESTS_STAGE}, using assistants for {stage}")
+        backend_name = AssistantsBackend.name
+
+    if backend_name == JobQueueBackend.name:
+        queue_config = read_queue_config()
+        return JobQueueBackend(
+            stage,
+            JobQueue(
+                queue_config["path"],
+                queue_config["max_attempts"],
+                queue_config["shared"],
+            ),
+        )
+
+    if backend_name == ChatCompletionsBackend.name:
+        return ChatCompletionsBackend(
+            client,
+            stage,
+            section.get("CHAT_MODEL", DEFAULT_CHAT_MODEL),
+            int(section.get("CHAT_MAX_TOKENS", DEFAULT_CHAT_MAX_TOKENS)),
+            STAGE_INSTRUCTIONS[stage],
+        )
+
+    if backend_name != AssistantsBackend.name:
+        print(f"Unknown backend {backend_name} for {stage}, using assistants")
+
+    if stage == IDEAS_STAGE:
+        assistant_id = section.get("IDEAS_ASSISTANT_ID", IDEAS_ASSISTANT_ID)
+    else:
+        assistant_id = section.get("TESTS_ASSISTANT_ID", TESTS_ASSISTANT_ID)
+
+    return AssistantsBackend(client, stage, assistant_id)
+
+
+class GenerationTask(PooledTask):
+    status_updated = pyqtSignal(str)
+    generation_finished = pyqtSignal(str)
+    generation_failed = pyqtSignal(str)
+    run_submitted = pyqtSignal(str, str)
+
+    def __init__(
+        self,
+        backend,
+        message_content,
+        file_paths,
+        file_ids,
+        test_name=None,
+        pair=None,
+        resumed_run=None,
+        route=None,
+    ):
+        super().__init__()
+        self.backend = backend
+        self.message_content = message_content
+        self.file_paths = file_paths
+        self.file_ids = file_ids
+        self.test_name = test_name
+        self.pair = pair
+        # (thread id, run id) of a run submitted by an earlier session
+        self.resumed_run = resumed_run
+        self.route = route
+        self.run_id = None
+        self.start_time = None
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def run(self):
+        self.start_time = time.monotonic()
+        try:
+            if not self.backend.polls_runs:
+                content, usage = self.backend.generate(
+                    self.message_content,
+                    self.file_paths,
+                    self.file_ids,
+                    on_status=self.status_updated.emit,
+                    should_stop=lambda: self.cancelled,
+                    route=self.route,
+                )
+                self.record_usage(usage)
+                self.generation_finished.emit(content)
+                return
+
+            if self.resumed_run is not None:
+                thread_id, run_id = self.resumed_run
+            else:
+                run = self.backend.submit(
+                    self.message_content, self.file_paths, self.file_ids, self.route
+                )
+                thread_id, run_id = run.thread_id, run.id
+                self.run_submitted.emit(thread_id, run_id)
+        except Exception as e:
+            self.generation_failed.emit(str(e))
+            return
+
+        self.run_id = run_id
+
+        # the run is handed to the shared poller, which frees this worker
+        # until the run reaches a final status
+        self.hold()
+        run_poller.track(
+            self.backend,
+            thread_id,
+            run_id,
+            self.status_updated.emit,
+            self.run_done,
+            should_stop=lambda: self.cancelled,
+            hedge=self.hedge if self.can_hedge() else None,
+            record_usage=self.record_usage,
+        )
+
+    def can_hedge(self):
+
+        # a duplicate needs the original prompt and a backend that makes runs
+        return self.resumed_run is None and self.backend.name == AssistantsBackend.name
+
+    def hedge(self):
+
+        run = self.backend.submit(
+            self.message_content, self.file_paths, self.file_ids, self.route
+        )
+
+        return run.thread_id, run.id
+
+    def run_done(self, run):
+
+        if run is None:
+            self.generation_failed.emit("Run cancelled")
+        else:
+            # chat calls observe themselves, polled runs are timed here
+            if self.route is not None and self.backend.name == AssistantsBackend.name:
+                model_router.observe(
+                    self.route.model,
+                    time.monotonic() - self.start_time,
+                    run.status == "completed",
+                )
+            self.submit(self.collect, run)
+
+        self.release()
+
+    def collect(self, run):
+        try:
+            content, usage = self.backend.collect(run)
+        except Exception as e:
+            self.generation_failed.emit(str(e))
+            return
+        self.record_usage(usage)
+        self.generation_finished.emit(content)
+
+    def record_usage(self, usage):
+        usage_ledger.record(self.backend.stage, usage, self.test_name, self.pair)
@@ -0,0 +1,379 @@
+import difflib
+import hashlib
+import os
+import re
+import stat
+
+from git import BadName
+
+
+SYMLINK_MODE = 0o120000
+SUBMODULE_MODE = 0o160000
+
+
+def blob_sha(data):
+
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).digest()
+
+
+def translate_pattern(pattern):
+
+    regex = ""
+    index = 0
+
+    while index < len(pattern):
+        if pattern.startswith("**/", index):
+            regex += "(?:.*/)?"
+            index += 3
+        elif pattern.startswith("/**", index) and index + 3 == len(pattern):
+            regex += "/.*"
+            index += 3
+        elif pattern.startswith("**", index):
+            regex += ".*"
+            index += 2
+        elif pattern[index] == "*":
+            regex += "[^/]*"
+            index += 1
+        elif pattern[index] == "?":
+            regex += "[^/]"
+            index += 1
+        elif pattern[index] == "[" and "]" in pattern[index + 1 :]:
+            end = pattern.index("]", index + 1)
+            regex += "[" + pattern[index + 1 : end].replace("!", "^", 1) + "]"
+            index = end + 1
+        elif pattern[index] == "\\" and index + 1 < len(pattern):
+            regex += re.escape(pattern[index + 1])
+            index += 2
+        else:
+            regex += re.escape(pattern[index])
+            index += 1
+
+    return re.compile(regex + r"\Z")
+
+
+class IgnoreRule:
+    def __init__(self, line, base):
+        self.negated = line.startswith("!")
+        if self.negated:
+            line = line[1:]
+
+        self.directory_only = line.endswith("/")
+        line = line.rstrip("/")
+
+        # patterns without an inner slash match the name at any depth
+        self.anchored = "/" in line
+        self.base = base
+        self.regex = translate_pattern(line.lstrip("/"))
+
+    def matches(self, path, is_directory):
+
+        if self.directory_only and not is_directory:
+            return False
+
+        if self.base:
+            if not path.startswith(self.base + "/"):
+                return False
+            path = path[len(self.base) + 1 :]
+
+        if self.anchored:
+            return bool(self.regex.match(path))
+
+        return bool(self.regex.match(path.rsplit("/", 1)[-1]))
+
+
+def read_ignore_rules(file_path, base):
+
+    rules = []
+
+    try:
+        with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return rules
+
+    for line in lines:
+        if not line.endswith("\\ "):
+            line = line.rstrip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("\\#") or line.startswith("\\!"):
+            line = line[1:]
+        rules.append(IgnoreRule(line, base))
+
+    return rules
+
+
+def is_ignored(rules, path, is_directory):
+
+    ignored = False
+
+    for rule in rules:
+        if rule.matches(path, is_directory):
+            ignored = not rule.negated
+
+    return ignored
+
+
+def iter_working_files(working_dir, rules, excluded_dirs=(), subdir=""):
+
+    # .gitignore files above the subdirectory still apply inside it
+    parts = [part for part in subdir.split("/") if part]
+    for depth in range(len(parts)):
+        base = "/".join(parts[:depth])
+        rules = rules + read_ignore_rules(
+            os.path.join(working_dir, base, ".gitignore"), base
+        )
+
+    for root, dirs, files in os.walk(os.path.join(working_dir, *parts)):
+        relative_root = os.path.relpath(root, working_dir).replace(os.sep, "/")
+        if relative_root == ".":
+            relative_root = ""
+
+        rules = rules + read_ignore_rules(
+            os.path.join(root, ".gitignore"), relative_root
+        )
+
+        kept_dirs = []
+        for directory in sorted(dirs):
+            path = f"{relative_root}/{directory}".lstrip("/")
+            # excluded directories are pruned before any of their content is
+            # listed
+            if (
+                path == ".git"
+                or directory in excluded_dirs
+                or is_ignored(rules, path, True)
+            ):
+                continue
+            kept_dirs.append(directory)
+        dirs[:] = kept_dirs
+
+        for file in sorted(files):
+            path = f"{relative_root}/{file}".lstrip("/")
+            if not is_ignored(rules, path, False):
+                yield path
+
+
+class GitAccess:
+    def __init__(self, repo):
+        self.repo = repo
+        self.working_dir = repo.working_dir
+        self.index_path = os.path.join(repo.git_dir, "index")
+        self.index_stamp = None
+        self.entries = {}
+        self.converts_content = False
+        # (path, mtime, size) -> blob sha of files git would convert on add
+        self.converted_shas = {}
+
+    def load_index(self):
+
+        # the index is parsed in process and only again once git rewrites it
+        try:
+            index_stat = os.stat(self.index_path)
+            stamp = (index_stat.st_mtime_ns, index_stat.st_size)
+        except OSError:
+            stamp = None
+
+        if stamp == self.index_stamp:
+            return self.entries
+
+        self.repo.index.update()
+
+        self.entries = {
+            path: entry
+            for (path, stage), entry in self.repo.index.entries.items()
+            if stage == 0
+        }
+        self.index_stamp = stamp
+        self.converts_content = self.has_conversions()
+
+        return self.entries
+
+    def has_conversions(self):
+
+        # line ending conversion and clean filters change what git hashes,
+        # so raw working tree bytes can only be hashed when neither applies
+        autocrlf = str(
+            self.repo.config_reader().get_value("core", "autocrlf", "false")
+        ).lower()
+
+        return (
+            autocrlf in ("true", "input")
+            or os.path.exists(os.path.join(self.repo.git_dir, "info", "attributes"))
+            or any(path.rsplit("/", 1)[-1] == ".gitattributes" for path in self.entries)
+        )
+
+    def read_working_file(self, path):
+
+        full_path = os.path.join(self.working_dir, path)
+
+        if os.path.islink(full_path):
+            return os.readlink(full_path).encode()
+
+        with open(full_path, "rb") as f:
+            return f.read()
+
+    def is_modified(self, path, entry):
+
+        if entry.mode == SUBMODULE_MODE:
+            return False
+
+        try:
+            file_stat = os.lstat(os.path.join(self.working_dir, path))
+        except OSError:
+            return True
+
+        if entry.mode != SYMLINK_MODE and file_stat.st_size != entry.size:
+            return True
+
+        mtime_seconds, mtime_nanoseconds = divmod(file_stat.st_mtime_ns, 10**9)
+
+        # entries written without nanoseconds are compared to the second
+        stat_matches = mtime_seconds == entry.mtime[0] and (
+            entry.mtime[1] == 0 or mtime_nanoseconds == entry.mtime[1]
+        )
+
+        # an entry stamped no earlier than the index itself may have been
+        # edited again within the same second, git re-hashes those as well
+        racily_clean = self.index_stamp is not None and entry.mtime[0] >= (
+            self.index_stamp[0] // 10**9
+        )
+
+        if stat_matches and not racily_clean:
+            return False
+
+        # the stat data is stale, so compare content the way git does
+        return self.working_sha(path, file_stat) != entry.binsha
+
+    def working_sha(self, path, file_stat):
+
+        if not self.converts_content or stat.S_ISLNK(file_stat.st_mode):
+            return blob_sha(self.read_working_file(path))
+
+        key = (path, file_stat.st_mtime_ns, file_stat.st_size)
+
+        if key not in self.converted_shas:
+            # hash-object applies the attributes, autocrlf and clean filters
+            # exactly as git add would
+            self.converted_shas[key] = bytes.fromhex(
+                self.repo.git.hash_object("--", path)
+            )
+
+        return self.converted_shas[key]
+
+    def iter_modified_files(self):
+
+        for path, entry in sorted(self.load_index().items()):
+            if self.is_modified(path, entry):
+                yield path
+
+    def modified_files(self):
+
+        return list(self.iter_modified_files())
+
+    def ignore_rules(self):
+
+        # the global excludes file has the lowest precedence, then the
+        # repository's own exclude file, then the .gitignore files
+        return read_ignore_rules(self.global_excludes_path(), "") + read_ignore_rules(
+            os.path.join(self.repo.git_dir, "info", "exclude"), ""
+        )
+
+    def iter_untracked_files(self, excluded_dirs=()):
+
+        entries = self.load_index()
+
+        for path in iter_working_files(
+            self.working_dir, self.ignore_rules(), excluded_dirs
+        ):
+            if path not in entries:
+                yield path
+
+    def global_excludes_path(self):
+
+        excludes_path = self.repo.config_reader().get_value("core", "excludesfile", "")
+
+        if excludes_path:
+            return os.path.expanduser(str(excludes_path))
+
+        config_home = os.environ.get("XDG_CONFIG_HOME") or os.path.join(
+            os.path.expanduser("~"), ".config"
+        )
+
+        return os.path.join(config_home, "git", "ignore")
+
+    def untracked_files(self):
+
+        return list(self.iter_untracked_files())
+
+    def blob_data(self, binsha):
+
+        # object reads go through GitPython's persistent cat-file process
+        return self.repo.odb.stream(binsha).read()
+
+    def base_data(self, path, base):
+
+        if base == "index":
+            entry = self.load_index().get(path)
+            return None if entry is None else self.blob_data(entry.binsha)
+
+        try:
+            blob = self.repo.commit(base).tree / path
+        except (KeyError, BadName, ValueError):
+            return None
+
+        return self.blob_data(blob.binsha)
+
+    def diff(self, path, base="index"):
+
+        if os.path.isabs(path):
+            path = os.path.relpath(path, self.working_dir)
+        path = path.replace(os.sep, "/")
+
+        old_data = self.base_data(path, base)
+
+        try:
+            new_data = self.read_working_file(path)
+        except OSError:
+            new_data = None
+
+        if old_data == new_data:
+            return ""
+
+        header = [f"diff --git a/{path} b/{path}"]
+
+        if b"\0" in (old_data or b"") or b"\0" in (new_data or b""):
+            return "\n".join(header + [f"Binary files a/{path} and b/{path} differ"])
+
+        old_lines = (old_data or b"").decode("utf-8", errors="replace").splitlines()
+        new_lines = (new_data or b"").decode("utf-8", errors="replace").splitlines()
+
+        # files that only differ in line endings are what autocrlf checks out
+        if old_lines == new_lines and old_data is not None and new_data is not None:
+            return ""
+
+        return "\n".join(
+            header
+            + list(
+                difflib.unified_diff(
+                    old_lines,
+                    new_lines,
+                    "/dev/null" if old_data is None else f"a/{path}",
+                    "/dev/null" if new_data is None else f"b/{path}",
+                    lineterm="",
+                )
+            )
+        )
+
+
+git_accesses = {}
+
+
+def get_git_access(repo):
+
+    git_access = git_accesses.get(repo.working_dir)
+
+    if git_access is None:
+        git_access = GitAccess(repo)
+        git_accesses[repo.working_dir] = git_access
+
+    return git_access
@@ -0,0 +1,198 @@
+import hashlib
+import json
+import re
+import threading
+
+
+HUNK_CACHE_FILE = "hunk_cache.json"
+
+IDENTIFIER_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+WORD_PATTERN = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+")
+
+# words too common in test descriptions and code to tell hunks apart
+COMMON_WORDS = {
+    "a",
+    "an",
+    "and",
+    "async",
+    "be",
+    "bool",
+    "class",
+    "get",
+    "if",
+    "in",
+    "int",
+    "is",
+    "new",
+    "null",
+    "of",
+    "on",
+    "or",
+    "public",
+    "private",
+    "return",
+    "returns",
+    "set",
+    "should",
+    "string",
+    "test",
+    "that",
+    "the",
+    "to",
+    "true",
+    "false",
+    "var",
+    "void",
+    "when",
+    "with",
+}
+
+
+def split_words(text):
+
+    words = set()
+
+    for identifier in IDENTIFIER_PATTERN.findall(text):
+        for word in WORD_PATTERN.findall(identifier):
+            word = word.lower()
+            if len(word) > 2 and word not in COMMON_WORDS:
+                words.add(word)
+
+    return words
+
+
+def parse_hunks(diff):
+
+    hunks = []
+    path = None
+
+    for line in diff.split("\n"):
+        if line.startswith("+++ "):
+            path = line[4:].removeprefix("b/")
+        elif (
+            line.startswith("--- ")
+            or line.startswith("diff ")
+            or line.startswith("index ")
+        ):
+            continue
+        elif line.startswith("@@"):
+            hunks.append({"path": path, "header": line, "lines": []})
+        elif hunks and line[:1] in ("+", "-", " "):
+            hunks[-1]["lines"].append(line)
+
+    for hunk in hunks:
+        changed_lines = [line for line in hunk["lines"] if line[:1] in ("+", "-")]
+
+        # line numbers are left out so that a hunk keeps its fingerprint when
+        # an edit elsewhere in the file shifts it
+        hunk["fingerprint"] = hashlib.sha1(
+            "\n".join([hunk["path"] or ""] + changed_lines).encode()
+        ).hexdigest()
+        hunk["words"] = split_words("\n".join(hunk["lines"] + [hunk["header"]]))
+        hunk["changes"] = "\n".join(changed_lines)
+
+    return hunks
+
+
+def format_hunks(hunks):
+
+    return "\n".join(hunk["changes"] for hunk in hunks if hunk["changes"])
+
+
+def relevant_fingerprints(test, hunks):
+
+    test_words = split_words(f"{test['test-name']} {test['test-description']}")
+
+    relevant = [hunk["fingerprint"] for hunk in hunks if test_words & hunk["words"]]
+
+    # a test that cannot be tied to any hunk depends on all of them
+    return sorted(relevant or [hunk["fingerprint"] for hunk in hunks])
+
+
+class HunkCache:
+    def __init__(self, cache_path=HUNK_CACHE_FILE):
+        self.cache_path = cache_path
+        self.lock = threading.Lock()
+
+    def load(self):
+
+        try:
+            with open(self.cache_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, cache):
+
+        try:
+            with open(self.cache_path, "w") as f:
+                json.dump(cache, f)
+        except OSError as e:
+            print(f"Failed to save hunk cache: {e}")
+
+    def pair_key(self, initial_file_path, test_file_path):
+
+        return f"{initial_file_path}|{test_file_path}"
+
+    def cached_ideas(self, pair_key):
+
+        with self.lock:
+            entry = self.load().get(pair_key, {})
+
+        return entry.get("ideas", []), set(entry.get("fingerprints", []))
+
+    def store_ideas(self, pair_key, ideas, hunks):
+
+        fingerprints = {hunk["fingerprint"] for hunk in hunks}
+
+        with self.lock:
+            cache = self.load()
+            entry = cache.setdefault(pair_key, {})
+            entry["ideas"] = ideas
+            entry["fingerprints"] = sorted(fingerprints)
+
+            # tests tied to hunks that no longer exist can never be reused
+            entry["tests"] = {
+                test_name: test
+                for test_name, test in entry.get("tests", {}).items()
+                if fingerprints.issuperset(test["fingerprints"])
+            }
+            self.save(cache)
+
+    def cached_test(self, pair_key, test):
+
+        if "hunk-fingerprints" not in test:
+            return None
+
+        with self.lock:
+            entry = self.load().get(pair_key, {})
+
+        cached = entry.get("tests", {}).get(test["test-name"])
+
+        if (
+            cached is None
+            or cached["description"] != test["test-description"]
+            or cached["fingerprints"] != test["hunk-fingerprints"]
+        ):
+            return None
+
+        return cached["code"]
+
+    def store_test(self, pair_key, test, code):
+
+        if "hunk-fingerprints" not in test:
+            return
+
+        with self.lock:
+            cache = self.load()
+            cache.setdefault(pair_key, {}).setdefault("tests", {})[
+                test["test-name"]
+            ] = {
+                "description": test["test-description"],
+                "fingerprints": test["hunk-fingerprints"],
+                "code": code,
+            }
+            self.save(cache)
+
+
+hunk_cache = HunkCache()
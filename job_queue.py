@@ -0,0 +1,264 @@
+import configparser
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+
+DEFAULT_QUEUE_FILE = "job_queue.db"
+DEFAULT_LEASE_SECONDS = 300
+DEFAULT_MAX_ATTEMPTS = 3
+RETRY_DELAY_SECONDS = 30
+
+JOB_QUEUED = "queued"
+JOB_LEASED = "leased"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+
+def read_queue_config():
+
+    config = configparser.ConfigParser()
+
+    config.read("config.ini")
+
+    section = config["QUEUE"] if "QUEUE" in config else {}
+
+    return {
+        "path": section.get("PATH", DEFAULT_QUEUE_FILE),
+        "lease_seconds": int(section.get("LEASE_SECONDS", DEFAULT_LEASE_SECONDS)),
+        "max_attempts": int(section.get("MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS)),
+        "worker_backend": section.get("WORKER_BACKEND", "assistants"),
+        "shared": config.getboolean("QUEUE", "SHARED", fallback=False),
+    }
+
+
+def worker_name():
+
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class JobQueue:
+    def __init__(
+        self,
+        queue_path=DEFAULT_QUEUE_FILE,
+        max_attempts=DEFAULT_MAX_ATTEMPTS,
+        shared=False,
+    ):
+        self.queue_path = queue_path
+        self.max_attempts = max_attempts
+        # WAL keeps its index in shared memory, which processes on other
+        # hosts cannot see, so a queue on a network share uses the rollback
+        # journal and relies on the share's file locks instead
+        self.shared = shared or queue_path.startswith(("\\\\", "//"))
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def connect(self):
+
+        if self.connection is not None:
+            return self.connection
+
+        # transactions are opened explicitly so a claim can take the write
+        # lock before it reads which job is free
+        self.connection = sqlite3.connect(
+            self.queue_path, check_same_thread=False, timeout=30, isolation_level=None
+        )
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute(
+            "PRAGMA journal_mode=DELETE" if self.shared else "PRAGMA journal_mode=WAL"
+        )
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                pair TEXT,
+                prompt TEXT,
+                files TEXT,
+                test TEXT,
+                status TEXT,
+                attempts INTEGER DEFAULT 0,
+                max_attempts INTEGER,
+                lease_owner TEXT,
+                lease_expires REAL,
+                available_at REAL,
+                result TEXT,
+                error TEXT,
+                created REAL,
+                updated REAL
+            )
+            """
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, available_at)"
+        )
+
+        return self.connection
+
+    def transaction(self, statements):
+
+        with self.lock:
+            connection = self.connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements(connection)
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+            return result
+
+    def enqueue(self, pair, prompt, file_paths, test):
+
+        # the files are snapshotted so a worker on another machine does not
+        # need the repository
+        files = []
+        for file_path in file_paths:
+            with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+                files.append({"name": os.path.basename(file_path), "content": f.read()})
+
+        now = time.time()
+
+        return self.transaction(
+            lambda connection: connection.execute(
+                "INSERT INTO jobs (pair, prompt, files, test, status, max_attempts, "
+                "available_at, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    pair,
+                    prompt,
+                    json.dumps(files),
+                    json.dumps(test),
+                    JOB_QUEUED,
+                    self.max_attempts,
+                    now,
+                    now,
+                    now,
+                ),
+            ).lastrowid
+        )
+
+    def claim(self, owner, lease_seconds=DEFAULT_LEASE_SECONDS):
+
+        def claim_job(connection):
+
+            now = time.time()
+
+            # leases of workers that stopped renewing them are taken over
+            row = connection.execute(
+                "SELECT * FROM jobs WHERE (status = ? AND available_at <= ?) "
+                "OR (status = ? AND lease_expires < ?) ORDER BY id LIMIT 1",
+                (JOB_QUEUED, now, JOB_LEASED, now),
+            ).fetchone()
+
+            if row is None:
+                return None
+
+            if row["attempts"] >= row["max_attempts"]:
+                connection.execute(
+                    "UPDATE jobs SET status = ?, error = ?, updated = ? WHERE id = ?",
+                    (JOB_FAILED, row["error"] or "Lease expired", now, row["id"]),
+                )
+                return claim_job(connection)
+
+            connection.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts + 1, "
+                "lease_owner = ?, lease_expires = ?, updated = ? WHERE id = ?",
+                (JOB_LEASED, owner, now + lease_seconds, now, row["id"]),
+            )
+
+            job = dict(row)
+            job["files"] = json.loads(job["files"])
+            job["test"] = json.loads(job["test"])
+            return job
+
+        return self.transaction(claim_job)
+
+    def renew(self, job_id, owner, lease_seconds=DEFAULT_LEASE_SECONDS):
+
+        return self.transaction(
+            lambda connection: connection.execute(
+                "UPDATE jobs SET lease_expires = ? WHERE id = ? AND status = ? "
+                "AND lease_owner = ?",
+                (time.time() + lease_seconds, job_id, JOB_LEASED, owner),
+            ).rowcount
+            > 0
+        )
+
+    def complete(self, job_id, owner, result):
+
+        return self.transaction(
+            lambda connection: connection.execute(
+                "UPDATE jobs SET status = ?, result = ?, updated = ? WHERE id = ? "
+                "AND status = ? AND lease_owner = ?",
+                (JOB_DONE, result, time.time(), job_id, JOB_LEASED, owner),
+            ).rowcount
+            > 0
+        )
+
+    def fail(self, job_id, owner, error):
+
+        def fail_job(connection):
+
+            row = connection.execute(
+                "SELECT attempts, max_attempts FROM jobs WHERE id = ? AND status = ? "
+                "AND lease_owner = ?",
+                (job_id, JOB_LEASED, owner),
+            ).fetchone()
+
+            if row is None:
+                return False
+
+            now = time.time()
+
+            if row["attempts"] >= row["max_attempts"]:
+                status, available_at = JOB_FAILED, now
+            else:
+                status = JOB_QUEUED
+                available_at = now + RETRY_DELAY_SECONDS * row["attempts"]
+
+            connection.execute(
+                "UPDATE jobs SET status = ?, error = ?, available_at = ?, "
+                "lease_owner = NULL, updated = ? WHERE id = ?",
+                (status, error, available_at, now, job_id),
+            )
+            return True
+
+        return self.transaction(fail_job)
+
+    def cancel(self, job_id):
+
+        self.transaction(
+            lambda connection: connection.execute(
+                "UPDATE jobs SET status = ?, updated = ? WHERE id = ? "
+                "AND status IN (?, ?)",
+                (JOB_CANCELLED, time.time(), job_id, JOB_QUEUED, JOB_LEASED),
+            )
+        )
+
+    def job(self, job_id):
+
+        with self.lock:
+            row = (
+                self.connect()
+                .execute(
+                    "SELECT id, status, attempts, result, error FROM jobs WHERE id = ?",
+                    (job_id,),
+                )
+                .fetchone()
+            )
+
+        return None if row is None else dict(row)
+
+    def counts(self):
+
+        with self.lock:
+            rows = (
+                self.connect()
+                .execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+                .fetchall()
+            )
+
+        return {status: count for status, count in rows}
@@ -1,9 +1,13 @@
 from PyQt6.QtWidgets import QApplication
 
+from diagnostics import start_diagnostics
+from file_manager import start_orphan_collection
 from repository_view import RepositoryView
 
 if __name__ == "__main__":
     app = QApplication([])
+    stall_watchdog = start_diagnostics()
+    start_orphan_collection()
     repo_view = RepositoryView()
     repo_view.show()
     app.exec()
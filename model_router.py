@@ -0,0 +1,266 @@
+import configparser
+import statistics
+import threading
+import time
+from collections import deque
+
+
+EXTRACTION_STAGE = "extraction"
+
+FAST_TIER = "fast"
+STANDARD_TIER = "standard"
+STRONG_TIER = "strong"
+
+TIERS = [FAST_TIER, STANDARD_TIER, STRONG_TIER]
+
+DEFAULT_TIER_SETTINGS = {
+    FAST_TIER: {"model": "gpt-3.5-turbo", "max_tokens": 1000, "temperature": 1.0},
+    STANDARD_TIER: {
+        "model": "gpt-4-turbo-preview",
+        "max_tokens": 2000,
+        "temperature": 1.0,
+    },
+    STRONG_TIER: {"model": "gpt-4", "max_tokens": 3000, "temperature": 1.0},
+}
+
+# most chat models cap a completion at 4096 tokens whatever the context size
+DEFAULT_MAX_OUTPUT_TOKENS = 4096
+MODEL_OUTPUT_TOKENS = {"gpt-4o": 16384, "gpt-4o-mini": 16384}
+
+DEFAULT_SMALL_CHANGE_LINES = 10
+DEFAULT_LARGE_CHANGE_LINES = 200
+DEFAULT_SIMPLE_DESCRIPTION_WORDS = 40
+DEFAULT_COMPLEX_BATCH_SIZE = 3
+DEFAULT_LATENCY_WINDOW = 20
+DEFAULT_MAX_ERROR_RATE = 0.25
+DEFAULT_MAX_MEDIAN_LATENCY = 120
+DEFAULT_HEALTH_EXPIRY = 300
+
+# a model is judged only once it has a few calls behind it
+MIN_OBSERVATIONS = 3
+
+
+def read_routing_config():
+
+    config = configparser.ConfigParser()
+
+    config.read("config.ini")
+
+    section = config["ROUTING"] if "ROUTING" in config else {}
+
+    tiers = {}
+    for tier in TIERS:
+        defaults = DEFAULT_TIER_SETTINGS[tier]
+        prefix = tier.upper()
+        tiers[tier] = {
+            "model": section.get(f"{prefix}_MODEL", defaults["model"]),
+            "max_tokens": int(
+                section.get(f"{prefix}_MAX_TOKENS", defaults["max_tokens"])
+            ),
+            "temperature": float(
+                section.get(f"{prefix}_TEMPERATURE", defaults["temperature"])
+            ),
+        }
+
+    return {
+        "enabled": config.getboolean("ROUTING", "ENABLED", fallback=False),
+        "tiers": tiers,
+        "small_change_lines": int(
+            section.get("SMALL_CHANGE_LINES", DEFAULT_SMALL_CHANGE_LINES)
+        ),
+        "large_change_lines": int(
+            section.get("LARGE_CHANGE_LINES", DEFAULT_LARGE_CHANGE_LINES)
+        ),
+        "simple_description_words": int(
+            section.get("SIMPLE_DESCRIPTION_WORDS", DEFAULT_SIMPLE_DESCRIPTION_WORDS)
+        ),
+        "complex_batch_size": int(
+            section.get("COMPLEX_BATCH_SIZE", DEFAULT_COMPLEX_BATCH_SIZE)
+        ),
+        "latency_window": int(section.get("LATENCY_WINDOW", DEFAULT_LATENCY_WINDOW)),
+        "max_error_rate": float(section.get("MAX_ERROR_RATE", DEFAULT_MAX_ERROR_RATE)),
+        "max_median_latency": float(
+            section.get("MAX_MEDIAN_LATENCY", DEFAULT_MAX_MEDIAN_LATENCY)
+        ),
+        "health_expiry": float(section.get("HEALTH_EXPIRY", DEFAULT_HEALTH_EXPIRY)),
+    }
+
+
+def max_output_tokens(model):
+
+    return MODEL_OUTPUT_TOKENS.get(model, DEFAULT_MAX_OUTPUT_TOKENS)
+
+
+def count_changed_lines(formatted_changes):
+
+    return sum(
+        1
+        for line in formatted_changes.split("\n")
+        if line[:1] in ("+", "-") and not line.startswith(("+++", "---"))
+    )
+
+
+class Route:
+    def __init__(self, tier, model, max_tokens, temperature):
+        self.tier = tier
+        self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+
+
+class ModelRouter:
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # model -> recent (observed at, seconds, succeeded) triples
+        self.observations = {}
+
+    def observe(self, model, seconds, succeeded):
+
+        window = read_routing_config()["latency_window"]
+
+        with self.lock:
+            observations = self.observations.get(model)
+            if observations is None or observations.maxlen != window:
+                observations = deque(observations or (), maxlen=window)
+                self.observations[model] = observations
+            observations.append((time.monotonic(), seconds, succeeded))
+
+    def is_healthy(self, model, settings):
+
+        # an unhealthy model gets no requests and so no new observations, so
+        # old ones expire and the model is tried again once they have
+        expired_before = time.monotonic() - settings["health_expiry"]
+
+        with self.lock:
+            observations = [
+                (seconds, succeeded)
+                for observed_at, seconds, succeeded in self.observations.get(model, ())
+                if observed_at >= expired_before
+            ]
+
+        if len(observations) < MIN_OBSERVATIONS:
+            return True
+
+        error_rate = sum(1 for _, succeeded in observations if not succeeded) / len(
+            observations
+        )
+        if error_rate > settings["max_error_rate"]:
+            return False
+
+        latencies = [seconds for seconds, succeeded in observations if succeeded]
+        return (
+            not latencies
+            or statistics.median(latencies) <= settings["max_median_latency"]
+        )
+
+    def choose_tier(self, settings, stage, changed_lines, tests):
+
+        # extraction only copies code out of a response, so it stays on the
+        # fast tier unless the response holds a large batch
+        if stage == EXTRACTION_STAGE:
+            if len(tests) >= settings["complex_batch_size"]:
+                return STANDARD_TIER
+            return FAST_TIER
+
+        description_words = sum(len(test["test-description"].split()) for test in tests)
+
+        if (
+            changed_lines <= settings["small_change_lines"]
+            and len(tests) <= 1
+            and description_words <= settings["simple_description_words"]
+        ):
+            return FAST_TIER
+
+        if (
+            changed_lines >= settings["large_change_lines"]
+            or len(tests) >= settings["complex_batch_size"]
+        ):
+            return STRONG_TIER
+
+        return STANDARD_TIER
+
+    def tier_route(self, settings, tier):
+
+        tier_settings = settings["tiers"][tier]
+
+        return Route(
+            tier,
+            tier_settings["model"],
+            tier_settings["max_tokens"],
+            tier_settings["temperature"],
+        )
+
+    def route(self, stage, changed_lines=0, tests=()):
+
+        settings = read_routing_config()
+
+        if not settings["enabled"]:
+            return None
+
+        tier = self.choose_tier(settings, stage, changed_lines, tests)
+
+        # a struggling model hands its requests to the nearest healthy tier
+        index = TIERS.index(tier)
+        candidates = sorted(TIERS, key=lambda other: abs(TIERS.index(other) - index))
+        for candidate in candidates:
+            if self.is_healthy(settings["tiers"][candidate]["model"], settings):
+                if candidate != tier:
+                    print(f"Routing {stage} to {candidate} instead of {tier}")
+                tier = candidate
+                break
+
+        route = self.tier_route(settings, tier)
+
+        print(
+            f"Routing {stage} ({changed_lines} changed lines, {len(tests)} tests) "
+            f"to {route.model}"
+        )
+
+        return route
+
+    def create_chat_completion(
+        self, client, route, messages, max_tokens=None, **kwargs
+    ):
+
+        start_time = time.monotonic()
+
+        try:
+            chat_response = client.chat.completions.create(
+                model=route.model,
+                messages=messages,
+                temperature=route.temperature,
+                max_tokens=max_tokens or route.max_tokens,
+                **kwargs,
+            )
+        except Exception:
+            self.observe(route.model, time.monotonic() - start_time, False)
+            raise
+
+        self.observe(route.model, time.monotonic() - start_time, True)
+
+        return chat_response
+
+    def extraction_route(self, test_count=1):
+
+        # extraction always goes through a chat call, so without routing it
+        # keeps using the fast tier settings
+        route = self.route(EXTRACTION_STAGE, tests=[None] * test_count)
+
+        if route is None:
+            route = self.tier_route(read_routing_config(), FAST_TIER)
+
+        return route
+
+    def extraction_batch_size(self, test_count):
+
+        # batched extraction asks for max_tokens per test, which has to stay
+        # within what the model can return in one completion
+        route = self.extraction_route(test_count)
+
+        return max(
+            1, min(test_count, max_output_tokens(route.model) // route.max_tokens)
+        )
+
+
+model_router = ModelRouter()
@@ -0,0 +1,85 @@
+import os
+
+# Every prompt is laid out from the most stable part to the most variable one:
+# static instructions, then the conventions and file context of the pair, then
+# the diff shared by every test of a session and finally the test itself. The
+# longer the byte-identical prefix, the more of it the provider can serve from
+# its prompt cache.
+
+IDEAS_INSTRUCTIONS = """Your task is to determine the NEW unit tests that need to be written to address the code modifications given at the end of this message. There is no minimum or maximum number of unit tests but for each one you must specify the name and provide a description. Make sure the suggested tests align correctly with the testing approach and examples already established."""
+
+TEST_INSTRUCTIONS = """Your task is to write the unit test described at the end of this message (either with Fact or Theory as you see fit in the xUnit framework). If at any point you are unsure of what needs to be written in any part of the unit test, provide INLINE comments for guidance in order to avoid false and confusing code. Again if you are unsure, provide inline comments."""
+
+BATCH_TEST_INSTRUCTIONS = """Your task is to write each of the unit tests listed at the end of this message (either with Fact or Theory as you see fit in the xUnit framework). Write the tests one after the other, starting each one with a line of the form "### <test name>" using the exact test name given. If at any point you are unsure of what needs to be written in any part of a unit test, provide INLINE comments for guidance in order to avoid false and confusing code. Again if you are unsure, provide inline comments."""
+
+
+def build_changes_section(formatted_changes):
+
+    return f"""Here are sections of the code that have been modified in the current commit:
+
+```
+{formatted_changes}
+```"""
+
+
+def build_conventions_section(test_file_name):
+
+    return f"Reference the TestsBase.cs file and especially the {test_file_name} file to ensure the same conventions, approach and style is used so that the unit test integrates well into the {test_file_name} file."
+
+
+def build_ideas_prompt(formatted_changes, initial_file_name, test_file_name):
+
+    return "\n\n".join(
+        [
+            IDEAS_INSTRUCTIONS,
+            f"Reference the {initial_file_name} and especially the {test_file_name} file to determine the tests.",
+            build_changes_section(formatted_changes),
+        ]
+    )
+
+
+def build_test_prompt(formatted_changes, test_description, test_file_name):
+
+    return "\n\n".join(
+        [
+            TEST_INSTRUCTIONS,
+            build_conventions_section(test_file_name),
+            build_changes_section(formatted_changes),
+            f"The unit test to write:\n\n{test_description}",
+        ]
+    )
+
+
+def build_batch_test_prompt(formatted_changes, tests, test_file_name):
+
+    test_sections = "\n\n".join(
+        f"{index}. {test['test-name']}: {test['test-description']}"
+        for index, test in enumerate(tests, start=1)
+    )
+
+    return "\n\n".join(
+        [
+            BATCH_TEST_INSTRUCTIONS,
+            build_conventions_section(test_file_name),
+            build_changes_section(formatted_changes),
+            f"The unit tests to write:\n\n{test_sections}",
+        ]
+    )
+
+
+def build_file_context(file_paths):
+
+    # test files change far less often than the sources they cover, so they
+    # go first to keep the cached prefix alive across edits of the source
+    ordered_paths = sorted(
+        file_paths, key=lambda path: not os.path.basename(path).endswith("Tests.cs")
+    )
+
+    file_sections = []
+    for file_path in ordered_paths:
+        with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+            file_sections.append(
+                f"{os.path.basename(file_path)}:\n\n```\n{f.read()}\n```"
+            )
+
+    return "\n\n".join(file_sections)
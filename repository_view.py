@@ -1,7 +1,10 @@
+import configparser
 import os
+import time
 from functools import partial
 from git import Repo, InvalidGitRepositoryError
-from PyQt6.QtCore import QTimer
+from openai import OpenAI
+from PyQt6.QtCore import Qt, QTimer
 
 from PyQt6.QtWidgets import (
     QWidget,
@@ -15,9 +18,33 @@ from PyQt6.QtWidgets import (
     QFileDialog,
 )
 
+from change_discovery import ChangeStream
 from change_view import ChangeView
+from context_index import ContextSelectionTask
+from diagnostics import diagnosed
+from file_manager import ORPHAN_AGE_SECONDS, FileManager, process_alive
+from generatedTests_view import GeneratedTestsView
+from generation_backend import TESTS_STAGE, run_backend
+from git_access import get_git_access
+from session_journal import session_journal
+from symbol_index import TestFileSearchTask
+from test_generator import TestGenerator
 from unitTest_view import UnitTestView
 
+MAX_INDEXED_TEST_FILES = 3
+
+
+def session_stopped(session):
+
+    alive = process_alive(session["pid"])
+
+    # liveness is unknown on Windows, so a session only counts as stopped
+    # once it has not been written to for as long as an orphaned upload
+    if alive is None:
+        return time.time() - session["updated"] > ORPHAN_AGE_SECONDS
+
+    return not alive
+
 
 class RepositoryView(QWidget):
     def __init__(self):
@@ -75,8 +102,166 @@ class RepositoryView(QWidget):
 
         self.repos = []
 
+        self.change_stream = None
+
         self.confirmed_file_pairs = []
 
+        self.resumed_views = []
+        self.context_tasks = []
+
+        QTimer.singleShot(0, self.resume_sessions)
+
+    @diagnosed("resume")
+    def resume_sessions(self):
+
+        config = configparser.ConfigParser()
+
+        config.read("config.ini")
+
+        if "OPENAI" not in config or "API_KEY" not in config["OPENAI"]:
+            return
+
+        client = OpenAI(api_key=config["OPENAI"]["API_KEY"])
+
+        for session in session_journal.sessions():
+            # sessions of another running instance are still in use
+            if session["pid"] != os.getpid() and not session_stopped(session):
+                continue
+
+            results = session_journal.results(session["id"])
+            remaining = [
+                test for test in session["tests"] if test["test-name"] not in results
+            ]
+
+            if not remaining:
+                self.discard_session(client, session)
+                continue
+
+            pair = " - ".join(
+                os.path.basename(path)
+                for path in [session["initial_file_path"], session["test_file_path"]]
+            )
+
+            answer = QMessageBox.question(
+                self,
+                "Resume Session",
+                f"A previous session for {pair} stopped with {len(remaining)} of "
+                f"{len(session['tests'])} tests not generated. Resume it?",
+            )
+
+            if answer == QMessageBox.StandardButton.Yes:
+                self.resume_session(client, session)
+            else:
+                self.discard_session(client, session)
+
+    def resume_session(self, client, session):
+
+        file_manager = FileManager(client)
+
+        try:
+            file_ids = [session["initial_file_id"], session["test_file_id"]]
+            missing_files = file_manager.missing_files(
+                [file_id for file_id in file_ids if file_id]
+            )
+
+            # files removed in the meantime are uploaded again
+            files = []
+            for file_id, file_path in zip(
+                file_ids, [session["initial_file_path"], session["test_file_path"]]
+            ):
+                if file_id and file_id not in missing_files:
+                    files.append(client.files.retrieve(file_id))
+                else:
+                    files.append(file_manager.upload([file_path])[0])
+
+            initial_file, test_file = files
+            session_journal.set_files(session["id"], initial_file.id, test_file.id)
+        except Exception as e:
+            QMessageBox.warning(
+                self, "Error", f"An error occurred while resuming the session: {e}"
+            )
+            return
+
+        # context files are not journaled, they are picked again from the
+        # repository as it is now, off the GUI thread
+        context_task = ContextSelectionTask(
+            Repo(session["initial_file_path"], search_parent_directories=True),
+            session["initial_file_path"],
+            session["test_file_path"],
+        )
+        context_task.context_selected.connect(
+            partial(self.open_resumed_session, client, session, initial_file, test_file)
+        )
+        self.context_tasks.append(context_task)
+        context_task.finished.connect(partial(self.context_tasks.remove, context_task))
+        context_task.start()
+
+    @diagnosed("resume")
+    def open_resumed_session(
+        self, client, session, initial_file, test_file, context_file_paths
+    ):
+
+        try:
+            context_files = list(
+                zip(
+                    context_file_paths,
+                    FileManager(client).upload(context_file_paths),
+                )
+            )
+
+            test_generator = TestGenerator(
+                client,
+                initial_file,
+                test_file,
+                session["formatted_changes"],
+                session["initial_file_path"],
+                session["test_file_path"],
+                session_id=session["id"],
+                context_files=context_files,
+            )
+        except Exception as e:
+            QMessageBox.warning(
+                self, "Error", f"An error occurred while resuming the session: {e}"
+            )
+            return
+
+        generated_tests_view = GeneratedTestsView(
+            session["tests"],
+            initial_file,
+            test_file,
+            session["formatted_changes"],
+            session["initial_file_path"],
+            session["test_file_path"],
+            test_generator,
+            context_files,
+        )
+        generated_tests_view.show()
+        self.resumed_views.append(generated_tests_view)
+
+    def discard_session(self, client, session):
+
+        try:
+            for run in session_journal.runs(session["id"]):
+                try:
+                    run_backend(
+                        client, TESTS_STAGE, run["backend"], run["thread_id"]
+                    ).cancel_run(run["thread_id"], run["run_id"])
+                except Exception as e:
+                    print(f"Failed to cancel run {run['run_id']}: {e}")
+
+            FileManager(client).delete(
+                [
+                    file_id
+                    for file_id in [session["initial_file_id"], session["test_file_id"]]
+                    if file_id
+                ]
+            )
+        except Exception as e:
+            print(f"Failed to clean up session {session['id']}: {e}")
+
+        session_journal.end_session(session["id"])
+
+    @diagnosed("changes")
     def find_associated_test_files(self):
 
         if not self.repos:
@@ -87,10 +272,12 @@ class RepositoryView(QWidget):
             )
             return
 
-        modified_files = self.repo.git.diff(None, name_only=True).split("\n")
+        modified_files = get_git_access(self.repo).modified_files()
 
         self.file_pairs = []
 
+        source_paths = []
+
         for file in modified_files:
 
             base_name = os.path.splitext(os.path.basename(file))[0]
@@ -109,6 +296,43 @@ class RepositoryView(QWidget):
                         )
                     )
 
+            source_path = os.path.join(self.repo.working_dir, file)
+
+            if file.endswith(".cs") and os.path.isfile(source_path):
+                source_paths.append(source_path)
+
+        # tests that exercise the files without following the naming
+        # convention are looked up in the symbol index off the GUI thread
+        self.test_button.setEnabled(False)
+        self.test_button.setText("Finding Test Files...")
+        self.test_file_search = TestFileSearchTask(
+            self.repo, source_paths, MAX_INDEXED_TEST_FILES
+        )
+        self.test_file_search.test_files_found.connect(
+            partial(self.indexed_test_files_found, self.repo)
+        )
+        self.test_file_search.start()
+
+    @diagnosed("changes")
+    def indexed_test_files_found(self, repo, test_files):
+
+        self.test_button.setText("Continue")
+        self.test_button.setEnabled(True)
+
+        # another repository may have been selected during the search
+        if repo is not self.repo:
+            return
+
+        # ranked by how often they reference the source file's symbols
+        for source_path, ranked_test_files in test_files.items():
+            for test_path, reference_count in ranked_test_files:
+                if (source_path, test_path) not in self.file_pairs:
+                    print(
+                        f"Paired {os.path.relpath(source_path, repo.working_dir)} "
+                        f"with {test_path} ({reference_count} references)"
+                    )
+                    self.file_pairs.append((source_path, test_path))
+
         self.display_file_pairs()
 
         self.test_button.hide()
@@ -146,6 +370,7 @@ class RepositoryView(QWidget):
 
         self.confirm_button.setEnabled(len(self.confirmed_file_pairs) > 0)
 
+    @diagnosed("changes")
     def select_change_clicked(self):
         if self.change_list.currentItem() is None:
             QMessageBox.warning(
@@ -157,7 +382,7 @@ class RepositoryView(QWidget):
 
         selected_change = self.change_list.currentItem().text()
         try:
-            change = self.repo.git.diff("HEAD", selected_change)
+            change = get_git_access(self.repo).diff(selected_change, "HEAD")
             self.change_view = ChangeView(change)
             self.change_view.show()
         except Exception as e:
@@ -208,13 +433,47 @@ class RepositoryView(QWidget):
 
     def display_changes(self, repo):
         self.change_list.clear()
-        changes = repo.git.diff(None, name_only=True).split("\n")
-        untracked_files = repo.untracked_files
-        for change in changes:
+
+        # changes are listed a page at a time between event loop iterations,
+        # so the first rows show up before the whole tree has been walked
+        self.change_stream = ChangeStream(get_git_access(repo))
+        self.display_next_change_page(self.change_stream)
+
+    @diagnosed("changes")
+    def display_next_change_page(self, change_stream):
+
+        if change_stream is not self.change_stream:
+            return
+
+        # later pages run from the event loop, outside select_clicked's
+        # error handling, so a failing page ends the listing here
+        try:
+            page = change_stream.next_page()
+        except Exception as e:
+            change_stream.done = True
+            item = QListWidgetItem(
+                f"Listing stopped after {change_stream.count} changes"
+            )
+            item.setFlags(Qt.ItemFlag.NoItemFlags)
+            self.change_list.addItem(item)
+            QMessageBox.warning(
+                self, "Error", f"An error occurred while listing the changes: {e}"
+            )
+            return
+
+        for change in page:
             self.change_list.addItem(QListWidgetItem(change))
-        for untracked_file in untracked_files:
-            self.change_list.addItem(QListWidgetItem(untracked_file))
 
+        if not change_stream.done:
+            QTimer.singleShot(0, lambda: self.display_next_change_page(change_stream))
+        elif change_stream.truncated:
+            item = QListWidgetItem(
+                f"Only the first {change_stream.count} changes are listed"
+            )
+            item.setFlags(Qt.ItemFlag.NoItemFlags)
+            self.change_list.addItem(item)
+
+    @diagnosed("changes")
     def confirm_clicked(self):
 
         self.confirm_button.setEnabled(False)
@@ -0,0 +1,461 @@
+import configparser
+import json
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt6.QtCore import QObject, pyqtSignal
+
+from usage_stats import BUDGET_OK, usage_ledger
+
+
+WORKER_COUNT = 8
+POLL_WORKER_COUNT = 4
+POLL_INTERVAL = 0.5
+MAX_RUN_DELAY = 15
+
+PENDING_RUN_STATUSES = ["queued", "in_progress", "cancelling"]
+
+LATENCY_FILE = "run_latency.json"
+LATENCY_HISTORY_SIZE = 200
+
+DEFAULT_HEDGE_PERCENTILE = 0.9
+DEFAULT_HEDGE_MIN_SAMPLES = 20
+DEFAULT_MAX_HEDGE_FRACTION = 0.2
+DEFAULT_MAX_HEDGES = 10
+
+worker_pool = ThreadPoolExecutor(max_workers=WORKER_COUNT, thread_name_prefix="api")
+
+
+class PooledTask(QObject):
+    finished = pyqtSignal()
+
+    def __init__(self):
+        super().__init__()
+        self.lock = threading.Lock()
+        self.pending = 0
+
+    def start(self):
+        self.submit(self.run)
+
+    def run(self):
+        pass
+
+    def submit(self, function, *args):
+        self.hold()
+        worker_pool.submit(self.call, function, *args)
+
+    def call(self, function, *args):
+        try:
+            function(*args)
+        except Exception as e:
+            print(f"Unhandled error in {type(self).__name__}: {e}")
+        finally:
+            self.release()
+
+    def hold(self):
+        with self.lock:
+            self.pending += 1
+
+    def release(self):
+        with self.lock:
+            self.pending -= 1
+            done = self.pending == 0
+        if done:
+            self.finished.emit()
+
+    def isRunning(self):
+        return self.pending > 0
+
+
+def read_hedging_config():
+
+    config = configparser.ConfigParser()
+
+    config.read("config.ini")
+
+    if "HEDGING" not in config:
+        return None
+
+    section = config["HEDGING"]
+
+    if not section.getboolean("ENABLED", False):
+        return None
+
+    return {
+        "percentile": section.getfloat("PERCENTILE", DEFAULT_HEDGE_PERCENTILE),
+        "min_samples": section.getint("MIN_SAMPLES", DEFAULT_HEDGE_MIN_SAMPLES),
+        "max_hedge_fraction": section.getfloat(
+            "MAX_HEDGE_FRACTION", DEFAULT_MAX_HEDGE_FRACTION
+        ),
+        "max_hedges": section.getint("MAX_HEDGES", DEFAULT_MAX_HEDGES),
+    }
+
+
+class LatencyHistory:
+    def __init__(self, latency_file=LATENCY_FILE):
+        self.latency_file = latency_file
+        self.lock = threading.Lock()
+        self.latencies = None
+
+    def load(self):
+
+        if self.latencies is None:
+            try:
+                with open(self.latency_file, "r") as f:
+                    self.latencies = json.load(f)
+            except (OSError, ValueError):
+                self.latencies = {}
+
+        return self.latencies
+
+    def record(self, stage, seconds):
+
+        with self.lock:
+            latencies = self.load().setdefault(stage, [])
+            latencies.append(round(seconds, 2))
+            del latencies[:-LATENCY_HISTORY_SIZE]
+
+            try:
+                with open(self.latency_file, "w") as f:
+                    json.dump(self.latencies, f)
+            except OSError as e:
+                print(f"Failed to save run latency: {e}")
+
+    def percentile(self, stage, fraction, min_samples):
+
+        with self.lock:
+            latencies = sorted(self.load().get(stage, []))
+
+        if len(latencies) < max(min_samples, 1):
+            return None
+
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+
+latency_history = LatencyHistory()
+
+
+class RunRace:
+    def __init__(self, on_done):
+        # the original run and its hedge, the first to complete wins
+        self.members = []
+        self.on_done = on_done
+        self.lock = threading.Lock()
+        self.hedged = False
+        self.done = False
+
+
+class TrackedRun:
+    def __init__(
+        self,
+        backend,
+        thread_id,
+        run_id,
+        on_status,
+        race,
+        should_stop,
+        hedge=None,
+        record_usage=None,
+    ):
+        self.backend = backend
+        self.thread_id = thread_id
+        self.run_id = run_id
+        self.on_status = on_status
+        self.race = race
+        self.should_stop = should_stop
+        self.hedge = hedge
+        self.record_usage = record_usage
+        self.started = time.monotonic()
+        self.finished = False
+        # cancelled losers are still polled until they stop, for their usage
+        self.draining = False
+        self.delay = 1
+        self.next_check = self.started + self.delay
+
+
+class RunPoller:
+    def __init__(self, interval=POLL_INTERVAL, worker_count=POLL_WORKER_COUNT):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.runs = {}
+        self.wakeup = threading.Event()
+        self.pool = ThreadPoolExecutor(
+            max_workers=worker_count, thread_name_prefix="run-poller"
+        )
+        self.thread = None
+
+        # runs tracked and hedges issued this session, for the hedge cap
+        self.run_count = 0
+        self.hedge_count = 0
+        self.pending_hedges = 0
+
+    def track(
+        self,
+        backend,
+        thread_id,
+        run_id,
+        on_status,
+        on_done,
+        should_stop=None,
+        hedge=None,
+        record_usage=None,
+    ):
+
+        race = RunRace(on_done)
+        tracked = TrackedRun(
+            backend,
+            thread_id,
+            run_id,
+            on_status,
+            race,
+            should_stop,
+            hedge,
+            record_usage,
+        )
+        race.members.append(tracked)
+
+        with self.lock:
+            self.runs[run_id] = tracked
+            self.run_count += 1
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.poll_loop, name="run-poller", daemon=True
+                )
+                self.thread.start()
+
+        self.wakeup.set()
+
+    def untrack(self, run_id):
+
+        with self.lock:
+            return self.runs.pop(run_id, None)
+
+    def tracked_count(self):
+
+        with self.lock:
+            return len(self.runs)
+
+    def poll_loop(self):
+
+        while True:
+            with self.lock:
+                idle = not self.runs
+            if idle:
+                self.wakeup.wait()
+                self.wakeup.clear()
+
+            time.sleep(self.interval)
+
+            now = time.monotonic()
+            with self.lock:
+                due_runs = [run for run in self.runs.values() if run.next_check <= now]
+
+            if not due_runs:
+                continue
+
+            # the hedging settings are read once a tick, not once for every run
+            try:
+                hedging = read_hedging_config()
+            except ValueError as e:
+                print(f"Invalid hedging settings: {e}")
+                hedging = None
+
+            # one tick checks every due run at once on the fixed poller pool
+            futures = [
+                (run, self.pool.submit(self.check, run, hedging)) for run in due_runs
+            ]
+            for run, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    # a run that fails to check must not stop polling for all
+                    # the others, it is retried later if it is still tracked
+                    print(f"Failed to check run {run.run_id}: {e}")
+                    run.delay = min(run.delay * 2, MAX_RUN_DELAY)
+                    run.next_check = time.monotonic() + run.delay
+
+    def check(self, tracked, hedging=None):
+
+        try:
+            if not tracked.draining and tracked.should_stop and tracked.should_stop():
+                tracked.backend.cancel_run(tracked.thread_id, tracked.run_id)
+                if self.untrack(tracked.run_id) is not None:
+                    self.stop(tracked)
+                return
+
+            run = tracked.backend.retrieve_run(tracked.thread_id, tracked.run_id)
+        except Exception as e:
+            print(f"Failed to check run {tracked.run_id}: {e}")
+            tracked.delay = min(tracked.delay * 2, MAX_RUN_DELAY)
+            tracked.next_check = time.monotonic() + tracked.delay
+            return
+
+        if tracked.draining:
+            if run.status in PENDING_RUN_STATUSES:
+                tracked.delay = min(tracked.delay * 2, MAX_RUN_DELAY)
+                tracked.next_check = time.monotonic() + tracked.delay
+            elif self.untrack(tracked.run_id) is not None:
+                tracked.record_usage(getattr(run, "usage", None))
+            return
+
+        tracked.on_status(run.status)
+
+        if run.status in PENDING_RUN_STATUSES:
+            self.maybe_hedge(tracked, hedging)
+            tracked.delay = min(tracked.delay * 2, MAX_RUN_DELAY)
+            tracked.next_check = time.monotonic() + tracked.delay
+            return
+
+        if self.untrack(tracked.run_id) is not None:
+            self.finish(tracked, run)
+
+    def stop(self, tracked):
+
+        race = tracked.race
+
+        # every member cancels itself, the last one reports the cancellation
+        with race.lock:
+            tracked.finished = True
+            last = not race.done and all(member.finished for member in race.members)
+            if last:
+                race.done = True
+
+        if last:
+            race.on_done(None)
+
+    def finish(self, tracked, run):
+
+        race = tracked.race
+
+        with race.lock:
+            if race.done:
+                return
+            tracked.finished = True
+            losers = [member for member in race.members if not member.finished]
+            if run.status != "completed" and losers:
+                print(f"Run {run.id} ended as {run.status}, waiting for its hedge")
+                return
+            race.done = True
+
+        for loser in losers:
+            if self.untrack(loser.run_id) is None:
+                continue
+            print(f"Cancelling run {loser.run_id}, run {run.id} finished first")
+            self.cancel_loser(loser)
+
+        if run.status == "completed":
+            latency_history.record(
+                tracked.backend.stage, time.monotonic() - tracked.started
+            )
+
+        race.on_done(run)
+
+    def cancel_loser(self, loser):
+
+        try:
+            loser.backend.cancel_run(loser.thread_id, loser.run_id)
+        except Exception as e:
+            print(f"Failed to cancel run {loser.run_id}: {e}")
+
+        if loser.record_usage is None:
+            return
+
+        # a cancelled run is charged for what it used so far, which is only
+        # known once it has stopped
+        loser.draining = True
+        loser.delay = 1
+        loser.next_check = time.monotonic() + loser.delay
+
+        with self.lock:
+            self.runs[loser.run_id] = loser
+
+        self.wakeup.set()
+
+    def maybe_hedge(self, tracked, settings):
+
+        race = tracked.race
+
+        if settings is None or tracked.hedge is None or race.hedged:
+            return
+
+        threshold = latency_history.percentile(
+            tracked.backend.stage, settings["percentile"], settings["min_samples"]
+        )
+        if threshold is None or time.monotonic() - tracked.started < threshold:
+            return
+
+        if usage_ledger.check_budget() != BUDGET_OK:
+            return
+
+        with race.lock:
+            if race.done or race.hedged:
+                return
+            race.hedged = True
+
+        # hedges are capped per session so the extra spend stays bounded, a
+        # hedge being submitted holds its place until it succeeds or fails
+        with self.lock:
+            issued = self.hedge_count + self.pending_hedges
+            capped = issued >= settings["max_hedges"] or issued >= math.ceil(
+                settings["max_hedge_fraction"] * self.run_count
+            )
+            if not capped:
+                self.pending_hedges += 1
+
+        if capped:
+            with race.lock:
+                race.hedged = False
+            return
+
+        # submitting takes several API calls, which would hold up every other
+        # run checked in this tick
+        worker_pool.submit(self.submit_hedge, tracked, threshold)
+
+    def submit_hedge(self, tracked, threshold):
+
+        race = tracked.race
+
+        try:
+            thread_id, run_id = tracked.hedge()
+        except Exception as e:
+            with self.lock:
+                self.pending_hedges -= 1
+            print(f"Failed to hedge run {tracked.run_id}: {e}")
+            return
+
+        with self.lock:
+            self.pending_hedges -= 1
+            self.hedge_count += 1
+
+        print(
+            f"Run {tracked.run_id} passed {threshold:.1f} s, hedged with run {run_id}"
+        )
+
+        hedge = TrackedRun(
+            tracked.backend,
+            thread_id,
+            run_id,
+            tracked.on_status,
+            race,
+            tracked.should_stop,
+            record_usage=tracked.record_usage,
+        )
+
+        with race.lock:
+            race.members.append(hedge)
+            done = race.done
+
+        # the original may have won while the hedge was being submitted
+        if done:
+            self.cancel_loser(hedge)
+            return
+
+        with self.lock:
+            self.runs[run_id] = hedge
+
+        self.wakeup.set()
+
+
+run_poller = RunPoller()
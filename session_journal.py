@@ -0,0 +1,218 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+
+JOURNAL_FILE = "session_journal.db"
+
+SESSION_ACTIVE = "active"
+
+
+class SessionJournal:
+    def __init__(self, journal_path=JOURNAL_FILE):
+        self.journal_path = journal_path
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def connect(self):
+
+        if self.connection is not None:
+            return self.connection
+
+        # results and runs arrive from pool threads as well as the GUI thread
+        self.connection = sqlite3.connect(
+            self.journal_path, check_same_thread=False, timeout=30
+        )
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sessions (
+                id TEXT PRIMARY KEY,
+                pid INTEGER,
+                status TEXT,
+                initial_file_path TEXT,
+                test_file_path TEXT,
+                initial_file_id TEXT,
+                test_file_id TEXT,
+                formatted_changes TEXT,
+                tests TEXT,
+                updated REAL
+            );
+            CREATE TABLE IF NOT EXISTS runs (
+                run_id TEXT PRIMARY KEY,
+                session_id TEXT,
+                thread_id TEXT,
+                tests TEXT,
+                created REAL,
+                backend TEXT
+            );
+            CREATE TABLE IF NOT EXISTS results (
+                session_id TEXT,
+                test_name TEXT,
+                code TEXT,
+                PRIMARY KEY (session_id, test_name)
+            );
+            """
+        )
+
+        # journals written before runs recorded their backend only hold
+        # assistants runs
+        columns = [
+            row["name"]
+            for row in self.connection.execute("PRAGMA table_info(runs)").fetchall()
+        ]
+        if "backend" not in columns:
+            self.connection.execute("ALTER TABLE runs ADD COLUMN backend TEXT")
+
+        return self.connection
+
+    def execute(self, statement, parameters=()):
+
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                return connection.execute(statement, parameters).fetchall()
+
+    def start_session(
+        self,
+        initial_file_path,
+        test_file_path,
+        initial_file_id,
+        test_file_id,
+        formatted_changes,
+    ):
+
+        session_id = uuid.uuid4().hex
+
+        self.execute(
+            "INSERT INTO sessions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                session_id,
+                os.getpid(),
+                SESSION_ACTIVE,
+                initial_file_path,
+                test_file_path,
+                initial_file_id,
+                test_file_id,
+                formatted_changes,
+                json.dumps([]),
+                time.time(),
+            ),
+        )
+
+        return session_id
+
+    def set_tests(self, session_id, tests):
+
+        self.execute(
+            "UPDATE sessions SET tests = ?, updated = ? WHERE id = ?",
+            (json.dumps(tests), time.time(), session_id),
+        )
+
+    def set_files(self, session_id, initial_file_id, test_file_id):
+
+        self.execute(
+            "UPDATE sessions SET initial_file_id = ?, test_file_id = ? WHERE id = ?",
+            (initial_file_id, test_file_id, session_id),
+        )
+
+    def claim_session(self, session_id):
+
+        self.execute(
+            "UPDATE sessions SET pid = ?, updated = ? WHERE id = ?",
+            (os.getpid(), time.time(), session_id),
+        )
+
+    def end_session(self, session_id):
+
+        self.execute("DELETE FROM runs WHERE session_id = ?", (session_id,))
+        self.execute("DELETE FROM results WHERE session_id = ?", (session_id,))
+        self.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def touch_session(self, session_id):
+
+        # another instance on a platform without a liveness check judges the
+        # session by how recently it was written to
+        self.execute(
+            "UPDATE sessions SET updated = ? WHERE id = ?", (time.time(), session_id)
+        )
+
+    def record_run(self, session_id, thread_id, run_id, tests, backend):
+
+        self.execute(
+            "INSERT OR REPLACE INTO runs (run_id, session_id, thread_id, tests, "
+            "created, backend) VALUES (?, ?, ?, ?, ?, ?)",
+            (run_id, session_id, thread_id, json.dumps(tests), time.time(), backend),
+        )
+        self.touch_session(session_id)
+
+    def drop_run(self, run_id):
+
+        self.execute("DELETE FROM runs WHERE run_id = ?", (run_id,))
+
+    def record_result(self, session_id, test_name, code):
+
+        self.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+            (session_id, test_name, code),
+        )
+        self.touch_session(session_id)
+
+    def runs(self, session_id):
+
+        return [
+            {
+                "thread_id": row["thread_id"],
+                "run_id": row["run_id"],
+                "tests": json.loads(row["tests"]),
+                "backend": row["backend"] or "assistants",
+            }
+            for row in self.execute(
+                "SELECT * FROM runs WHERE session_id = ? ORDER BY created",
+                (session_id,),
+            )
+        ]
+
+    def results(self, session_id):
+
+        return {
+            row["test_name"]: row["code"]
+            for row in self.execute(
+                "SELECT test_name, code FROM results WHERE session_id = ?",
+                (session_id,),
+            )
+        }
+
+    def sessions(self):
+
+        sessions = []
+
+        for row in self.execute(
+            "SELECT * FROM sessions WHERE status = ? ORDER BY updated",
+            (SESSION_ACTIVE,),
+        ):
+            session = dict(row)
+            session["tests"] = json.loads(session["tests"])
+            sessions.append(session)
+
+        return sessions
+
+    def file_ids(self):
+
+        # uploaded files still needed by sessions that can be resumed
+        return {
+            file_id
+            for row in self.execute(
+                "SELECT initial_file_id, test_file_id FROM sessions WHERE status = ?",
+                (SESSION_ACTIVE,),
+            )
+            for file_id in row
+            if file_id
+        }
+
+
+session_journal = SessionJournal()
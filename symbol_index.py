@@ -0,0 +1,172 @@
+import os
+import re
+import threading
+
+from PyQt6.QtCore import pyqtSignal
+
+from file_index import FileIndex
+from git_access import get_git_access
+from run_poller import PooledTask
+
+
+INDEX_VERSION = 1
+
+IDENTIFIER_PATTERN = re.compile(r"\b[A-Z][A-Za-z0-9_]*\b")
+TYPE_DECLARATION_PATTERN = re.compile(
+    r"\b(?:class|interface|struct|record|enum)\s+([A-Z][A-Za-z0-9_]*)"
+)
+MEMBER_DECLARATION_PATTERN = re.compile(
+    r"\b(?:public|internal|protected)\s+(?:(?:static|virtual|override|abstract|async|readonly|sealed|new|partial)\s+)*[\w<>\[\],.?]+\s+([A-Z][A-Za-z0-9_]*)\s*[({<=;]"
+)
+
+COMMENT_PATTERN = re.compile(r"//[^\n]*|/\*.*?\*/", re.DOTALL)
+STRING_PATTERN = re.compile(r'@?"(?:[^"\\\n]|\\.)*"')
+
+
+def read_code(file_path):
+
+    with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+        code = f.read()
+
+    return STRING_PATTERN.sub('""', COMMENT_PATTERN.sub("", code))
+
+
+def referenced_identifiers(file_path):
+
+    references = {}
+
+    for identifier in IDENTIFIER_PATTERN.findall(read_code(file_path)):
+        references[identifier] = references.get(identifier, 0) + 1
+
+    return references
+
+
+def declared_symbols(file_path):
+
+    code = read_code(file_path)
+
+    types = set(TYPE_DECLARATION_PATTERN.findall(code))
+    members = set(MEMBER_DECLARATION_PATTERN.findall(code)) - types
+
+    return types, members
+
+
+class SymbolIndex(FileIndex):
+
+    version = INDEX_VERSION
+    label = "Symbol"
+
+    def __init__(self, git_access, index_path, test_dir="test"):
+        self.test_dir = os.path.normpath(os.path.join(git_access.working_dir, test_dir))
+
+        # identifier -> {test file: count}
+        self.postings = {}
+
+        # test file -> {"mtime", "size", "references": {identifier: count}}
+        super().__init__(git_access, index_path, test_dir)
+
+    def read_entry(self, test_path):
+
+        return {"references": referenced_identifiers(test_path)}
+
+    def add_postings(self, test_path, entry):
+
+        for identifier, count in entry["references"].items():
+            self.postings.setdefault(identifier, {})[test_path] = count
+
+    def remove_postings(self, test_path, entry):
+
+        for identifier in entry["references"]:
+            postings = self.postings.get(identifier)
+            if postings is None:
+                continue
+            postings.pop(test_path, None)
+            if not postings:
+                del self.postings[identifier]
+
+    def is_test_file(self, file_path):
+
+        return os.path.normpath(file_path).startswith(self.test_dir + os.sep)
+
+    def find_test_files(self, source_path, limit=None):
+
+        # a modified test file would otherwise match its own declared types
+        if self.is_test_file(source_path):
+            return []
+
+        types, members = declared_symbols(source_path)
+
+        # a test file only counts when it references one of the declared
+        # types, member names on their own are too generic to pair on
+        scores = {}
+        for identifier in types:
+            for test_path, count in self.postings.get(identifier, {}).items():
+                scores[test_path] = scores.get(test_path, 0) + count
+
+        for identifier in members:
+            for test_path, count in self.postings.get(identifier, {}).items():
+                if test_path in scores:
+                    scores[test_path] += count
+
+        scores.pop(os.path.normpath(source_path), None)
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+        if limit is not None:
+            ranked = ranked[:limit]
+
+        return ranked
+
+
+symbol_indexes = {}
+
+# the index is built and queried from pool threads, one search at a time
+symbol_lock = threading.Lock()
+
+
+def get_symbol_index(repo):
+
+    symbol_index = symbol_indexes.get(repo.working_dir)
+
+    if symbol_index is None:
+        symbol_index = SymbolIndex(
+            get_git_access(repo),
+            os.path.join(repo.git_dir, "unit_test_generator", "symbol_index.json"),
+        )
+        symbol_indexes[repo.working_dir] = symbol_index
+
+    symbol_index.update()
+
+    return symbol_index
+
+
+def find_indexed_test_files(repo, source_paths, limit):
+
+    with symbol_lock:
+        symbol_index = get_symbol_index(repo)
+        return {
+            source_path: symbol_index.find_test_files(source_path, limit=limit)
+            for source_path in source_paths
+        }
+
+
+class TestFileSearchTask(PooledTask):
+    test_files_found = pyqtSignal(dict)
+
+    def __init__(self, repo, source_paths, limit=None):
+        super().__init__()
+        self.repo = repo
+        self.source_paths = source_paths
+        self.limit = limit
+
+    def run(self):
+        # bringing the index up to date walks the repository, which would
+        # block the window the search was started from
+        try:
+            test_files = find_indexed_test_files(
+                self.repo, self.source_paths, self.limit
+            )
+        except Exception as e:
+            print(f"Failed to search the symbol index: {e}")
+            test_files = {}
+        self.test_files_found.emit(test_files)
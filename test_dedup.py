@@ -0,0 +1,212 @@
+import configparser
+import math
+import os
+import re
+from collections import Counter
+
+from hunks import split_words
+
+
+DEDUP_OFF = "off"
+DEDUP_FLAG = "flag"
+DEDUP_FILTER = "filter"
+
+DEFAULT_THRESHOLD = 0.5
+
+# names carry more intent than bodies, which are mostly arrange/assert noise
+NAME_WEIGHT = 3
+
+TEST_ATTRIBUTE_PATTERN = re.compile(r"\[\s*(?:Fact|Theory)\b")
+TEST_METHOD_PATTERN = re.compile(
+    r"\b(?:void|Task(?:<[^>]*>)?|ValueTask)\s+(\w+)\s*\(", re.MULTILINE
+)
+
+
+def read_dedup_config():
+
+    config = configparser.ConfigParser()
+
+    config.read("config.ini")
+
+    section = config["DEDUP"] if "DEDUP" in config else {}
+
+    return {
+        "mode": section.get("MODE", DEDUP_FLAG).strip().lower(),
+        "threshold": float(section.get("THRESHOLD", DEFAULT_THRESHOLD)),
+    }
+
+
+def method_body(source, start):
+
+    open_index = source.find("{", start)
+    if open_index == -1:
+        open_index = len(source)
+
+    # expression-bodied tests end at the first semicolon instead
+    arrow_index = source.find("=>", start, open_index)
+    if arrow_index != -1:
+        end = source.find(";", arrow_index)
+        return source[arrow_index + 2 : end if end != -1 else len(source)]
+
+    if open_index == len(source):
+        return ""
+
+    depth = 0
+    index = open_index
+    while index < len(source):
+        character = source[index]
+        if character == '"':
+            # skip string literals so braces inside them are not counted
+            index += 1
+            while index < len(source) and source[index] != '"':
+                if source[index] == "\\":
+                    index += 1
+                index += 1
+        elif character == "{":
+            depth += 1
+        elif character == "}":
+            depth -= 1
+            if depth == 0:
+                return source[open_index + 1 : index]
+        index += 1
+
+    return source[open_index + 1 :]
+
+
+def parse_existing_tests(source):
+
+    tests = []
+
+    for attribute in TEST_ATTRIBUTE_PATTERN.finditer(source):
+        method = TEST_METHOD_PATTERN.search(source, attribute.end())
+        if method is None:
+            continue
+
+        # another test attribute before the method means this one had none
+        next_attribute = TEST_ATTRIBUTE_PATTERN.search(source, attribute.end())
+        if next_attribute is not None and next_attribute.start() < method.start():
+            continue
+
+        tests.append(
+            {"name": method.group(1), "body": method_body(source, method.end())}
+        )
+
+    return tests
+
+
+class ExistingTestIndex:
+    def __init__(self, tests):
+        self.names = []
+        self.name_words = []
+        self.vectors = []
+        self.postings = {}
+
+        documents = []
+        for test in tests:
+            name_words = split_words(test["name"])
+            terms = Counter(split_words(test["body"]))
+            for word in name_words:
+                terms[word] += NAME_WEIGHT
+            self.names.append(test["name"])
+            self.name_words.append(name_words)
+            documents.append(terms)
+
+        document_frequency = Counter(
+            word for terms in documents for word in terms.keys()
+        )
+        self.idf = {
+            word: math.log((1 + len(documents)) / (1 + count)) + 1
+            for word, count in document_frequency.items()
+        }
+
+        for position, terms in enumerate(documents):
+            self.vectors.append(self.weigh(terms))
+            for word in terms:
+                self.postings.setdefault(word, []).append(position)
+
+    def weigh(self, terms):
+
+        vector = {
+            word: count * self.idf.get(word, 0.0)
+            for word, count in terms.items()
+            if word in self.idf
+        }
+        norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+
+        if not norm:
+            return {}
+
+        return {word: weight / norm for word, weight in vector.items()}
+
+    def most_similar(self, idea):
+
+        name_words = split_words(idea["test-name"])
+        terms = Counter(split_words(idea["test-description"]))
+        for word in name_words:
+            terms[word] += NAME_WEIGHT
+        vector = self.weigh(terms)
+
+        # only tests sharing at least one word with the idea are scored
+        candidates = {
+            position for word in vector for position in self.postings.get(word, ())
+        }
+
+        best_name = None
+        best_score = 0.0
+        for position in candidates:
+            cosine = sum(
+                weight * self.vectors[position].get(word, 0.0)
+                for word, weight in vector.items()
+            )
+            union = name_words | self.name_words[position]
+            name_overlap = (
+                len(name_words & self.name_words[position]) / len(union)
+                if union
+                else 0.0
+            )
+            score = max(cosine, name_overlap)
+            if score > best_score:
+                best_name = self.names[position]
+                best_score = score
+
+        return best_name, best_score
+
+
+test_indexes = {}
+
+
+def get_test_index(test_file_path):
+
+    try:
+        file_stat = os.stat(test_file_path)
+    except OSError:
+        return ExistingTestIndex([])
+
+    stamp = (file_stat.st_mtime_ns, file_stat.st_size)
+
+    cached = test_indexes.get(test_file_path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+
+    with open(test_file_path, "r", encoding="utf-8", errors="replace") as f:
+        tests = parse_existing_tests(f.read())
+
+    print(f"Indexed {len(tests)} existing tests in {test_file_path}")
+
+    index = ExistingTestIndex(tests)
+    test_indexes[test_file_path] = (stamp, index)
+
+    return index
+
+
+def find_duplicates(ideas, test_file_path, threshold):
+
+    index = get_test_index(test_file_path)
+
+    duplicates = {}
+    for idea in ideas:
+        existing_name, score = index.most_similar(idea)
+        if score >= threshold:
+            duplicates[idea["test-name"]] = (existing_name, score)
+
+    return duplicates
@@ -0,0 +1,594 @@
+import configparser
+import json
+import os
+
+from PyQt6.QtCore import QObject, pyqtSignal
+
+from diagnostics import diagnosed
+from generation_backend import (
+    GenerationTask,
+    create_backend,
+    run_backend,
+    TESTS_STAGE,
+)
+from run_poller import PooledTask
+from hunks import hunk_cache
+from model_router import count_changed_lines, max_output_tokens, model_router
+from prompts import build_batch_test_prompt, build_test_prompt
+from session_journal import session_journal
+from usage_stats import usage_ledger
+
+
+DEFAULT_BATCH_TOKEN_BUDGET = 12000
+DEFAULT_MAX_BATCH_SIZE = 5
+EXPECTED_TEST_TOKENS = 400
+
+
+def estimate_tokens(text):
+
+    # roughly four characters per token for English and C#
+    return len(text) // 4
+
+
+def estimate_test_tokens(test):
+
+    return (
+        estimate_tokens(test["test-name"] + test["test-description"])
+        + EXPECTED_TEST_TOKENS
+    )
+
+
+def plan_batch(tests, shared_tokens, token_budget, max_batch_size):
+
+    batch = []
+    used_tokens = shared_tokens
+
+    for test in tests[:max_batch_size]:
+        test_tokens = estimate_test_tokens(test)
+        if batch and used_tokens + test_tokens > token_budget:
+            break
+        batch.append(test)
+        used_tokens += test_tokens
+
+    return batch
+
+
+def read_batch_config():
+
+    config = configparser.ConfigParser()
+
+    config.read("config.ini")
+
+    if "GENERATION" not in config:
+        return False, DEFAULT_BATCH_TOKEN_BUDGET, DEFAULT_MAX_BATCH_SIZE
+
+    section = config["GENERATION"]
+
+    return (
+        section.getboolean("BATCH_MODE", False),
+        section.getint("BATCH_TOKEN_BUDGET", DEFAULT_BATCH_TOKEN_BUDGET),
+        section.getint("MAX_BATCH_SIZE", DEFAULT_MAX_BATCH_SIZE),
+    )
+
+
+def read_speculative_config():
+
+    config = configparser.ConfigParser()
+
+    config.read("config.ini")
+
+    if "SPECULATIVE" not in config:
+        return False, 0, 0
+
+    section = config["SPECULATIVE"]
+
+    return (
+        section.getboolean("ENABLED", False),
+        section.getint("MAX_TESTS", 3),
+        section.getint("MAX_TOKENS", 0),
+    )
+
+
+def extract_test_code(client, content, test_name, pair=None):
+
+    chat_response = model_router.create_chat_completion(
+        client,
+        model_router.extraction_route(),
+        [
+            {
+                "role": "system",
+                "content": "You need to extract only the unit test code from the content and send only the unit test code back and nothing else.",
+            },
+            {
+                "role": "user",
+                "content": f"""return only the unit test code from the following content, do not include namespace, classes or anything but the unit test definition:
+
+                {content}""",
+            },
+        ],
+    )
+    usage_ledger.record("tests extraction", chat_response.usage, test_name, pair)
+
+    return chat_response
+
+
+class ChatAPITask(PooledTask):
+    response_received = pyqtSignal(object)
+    extraction_failed = pyqtSignal(str)
+
+    def __init__(self, client, content, test_name, pair=None):
+        super().__init__()
+        self.client = client
+        self.content = content
+        self.test_name = test_name
+        self.pair = pair
+
+    def run(self):
+        try:
+            chat_response = extract_test_code(
+                self.client, self.content, self.test_name, self.pair
+            )
+        except Exception as e:
+            self.extraction_failed.emit(str(e))
+            return
+        self.response_received.emit(chat_response)
+
+
+class BatchChatAPITask(PooledTask):
+    response_received = pyqtSignal(object)
+    extraction_failed = pyqtSignal(str)
+
+    def __init__(self, client, content, test_names, pair=None):
+        super().__init__()
+        self.client = client
+        self.content = content
+        self.test_names = test_names
+        self.pair = pair
+
+    def run(self):
+        try:
+            chat_response = self.extract()
+        except Exception as e:
+            self.extraction_failed.emit(str(e))
+            return
+        self.response_received.emit(chat_response)
+
+    def extract(self):
+        route = model_router.extraction_route(len(self.test_names))
+        chat_response = model_router.create_chat_completion(
+            self.client,
+            route,
+            [
+                {
+                    "role": "system",
+                    "content": "You need to extract the unit test code for each named unit test in a section of content and return them in a JSON format.",
+                },
+                {
+                    "role": "user",
+                    "content": f"""return json format with fields tests, test-name and test-code for the following unit tests: {", ".join(self.test_names)}. The test-code must contain only the unit test definition, do not include namespace, classes or anything else:
+
+                    {self.content}""",
+                },
+            ],
+            max_tokens=min(
+                route.max_tokens * len(self.test_names),
+                max_output_tokens(route.model),
+            ),
+            response_format={"type": "json_object"},
+        )
+        usage_ledger.record(
+            "tests extraction",
+            chat_response.usage,
+            ", ".join(self.test_names),
+            self.pair,
+        )
+        return chat_response
+
+
+class TestGenerator(QObject):
+
+    status_updated = pyqtSignal(str)
+    test_generated = pyqtSignal(str, str)
+    test_failed = pyqtSignal(str, str)
+
+    def __init__(
+        self,
+        client,
+        initial_file,
+        test_file,
+        formatted_changes,
+        initial_file_path,
+        test_file_path,
+        session_id=None,
+        context_files=(),
+    ):
+        super().__init__()
+
+        self.client = client
+        self.initial_file = initial_file
+        self.test_file = test_file
+        self.formatted_changes = formatted_changes
+        self.initial_file_path = initial_file_path
+        self.test_file_path = test_file_path
+        self.context_files = list(context_files)
+        self.test_file_name = os.path.basename(test_file_path)
+        self.pair = f"{os.path.basename(initial_file_path)} - {self.test_file_name}"
+        self.pair_key = hunk_cache.pair_key(initial_file_path, test_file_path)
+
+        self.backend = create_backend(client, TESTS_STAGE)
+
+        self.batch_mode, self.batch_token_budget, self.max_batch_size = (
+            read_batch_config()
+        )
+
+        # test name -> generation task, then extraction task once the
+        # generated content has been handed over for extraction. Tests in the
+        # same batch share their tasks, which keep the batch in .tests
+        self.jobs = {}
+        self.results = {}
+
+        # tasks no longer in jobs are kept alive until they have stopped
+        self.retired_jobs = []
+
+        # submitted runs and finished tests are journaled so that a crashed
+        # session can pick them up again
+        if session_id is None:
+            self.session_id = session_journal.start_session(
+                initial_file_path,
+                test_file_path,
+                initial_file.id if initial_file else None,
+                test_file.id if test_file else None,
+                formatted_changes,
+            )
+        else:
+            self.session_id = session_id
+            session_journal.claim_session(session_id)
+            self.results.update(session_journal.results(session_id))
+            self.resume_runs()
+
+    def file_paths(self):
+
+        return [self.initial_file_path, self.test_file_path] + [
+            file_path for file_path, _ in self.context_files
+        ]
+
+    def set_session_tests(self, tests):
+
+        session_journal.set_tests(self.session_id, tests)
+
+    def resume_runs(self):
+
+        for run in session_journal.runs(self.session_id):
+            tests = [
+                test
+                for test in run["tests"]
+                if test["test-name"] not in self.results
+                and test["test-name"] not in self.jobs
+            ]
+
+            if not tests:
+                session_journal.drop_run(run["run_id"])
+                continue
+
+            print(f"Resuming run {run['run_id']} for {len(tests)} tests")
+
+            generation_task = GenerationTask(
+                run_backend(self.client, TESTS_STAGE, run["backend"], run["thread_id"]),
+                None,
+                self.file_paths(),
+                [],
+                ", ".join(test["test-name"] for test in tests),
+                self.pair,
+                resumed_run=(run["thread_id"], run["run_id"]),
+            )
+            generation_task.status_updated.connect(self.status_updated)
+            generation_task.generation_finished.connect(self.generation_finished)
+            generation_task.generation_failed.connect(self.generation_failed)
+            # the run was asked for all of its tests, so batch extraction
+            # still expects every one of them
+            self.start_job(generation_task, tests, run["tests"])
+
+    def generate(self, test):
+
+        self.generate_batch([test])
+
+    def generate_batch(self, tests):
+
+        tests = [
+            test
+            for test in tests
+            if self.result(test) is None and test["test-name"] not in self.jobs
+        ]
+
+        if not tests:
+            return
+
+        # queue workers take one test per job
+        if len(tests) > 1 and self.backend.extracts_code:
+            for test in tests:
+                self.generate_batch([test])
+            return
+
+        print(f"Generating tests: {', '.join(test['test-name'] for test in tests)}")
+
+        if len(tests) == 1:
+            message_content = build_test_prompt(
+                self.formatted_changes,
+                tests[0]["test-description"],
+                self.test_file_name,
+            )
+        else:
+            message_content = build_batch_test_prompt(
+                self.formatted_changes, tests, self.test_file_name
+            )
+
+        backend = self.backend
+        if backend.extracts_code:
+            backend = backend.for_test(self.pair, tests[0])
+
+        route = model_router.route(
+            TESTS_STAGE, count_changed_lines(self.formatted_changes), tests
+        )
+
+        generation_task = GenerationTask(
+            backend,
+            message_content,
+            self.file_paths(),
+            [self.initial_file.id, self.test_file.id]
+            + [file.id for _, file in self.context_files],
+            ", ".join(test["test-name"] for test in tests),
+            self.pair,
+            route=route,
+        )
+        generation_task.status_updated.connect(self.status_updated)
+        generation_task.generation_finished.connect(self.generation_finished)
+        generation_task.generation_failed.connect(self.generation_failed)
+        generation_task.run_submitted.connect(self.run_submitted)
+        self.start_job(generation_task, tests)
+
+    def next_batch(self, tests):
+
+        # the shared context is paid once per batch, so the batch grows until
+        # the descriptions and expected output fill the remaining budget
+        tests = [
+            test
+            for test in tests
+            if self.result(test) is None and test["test-name"] not in self.jobs
+        ]
+
+        if not self.batch_mode:
+            return tests[:1]
+
+        return plan_batch(
+            tests, self.shared_tokens(), self.batch_token_budget, self.max_batch_size
+        )
+
+    def shared_tokens(self):
+
+        shared_tokens = estimate_tokens(self.formatted_changes)
+        for file_path in self.file_paths():
+            shared_tokens += os.path.getsize(file_path) // 4
+
+        return shared_tokens
+
+    def start_job(self, job, tests, batch=None):
+
+        job.tests = batch or tests
+        job.finished.connect(self.job_stopped)
+
+        for test in tests:
+            self.jobs[test["test-name"]] = job
+
+        job.start()
+
+    def live_tests(self, job):
+
+        return [test for test in job.tests if self.jobs.get(test["test-name"]) is job]
+
+    def is_pending(self, test):
+
+        return test["test-name"] in self.jobs
+
+    def result(self, test):
+
+        test_name = test["test-name"]
+
+        # tests whose hunks are unchanged since they were generated are reused
+        if test_name not in self.results and test_name not in self.jobs:
+            test_code = hunk_cache.cached_test(self.pair_key, test)
+            if test_code is not None:
+                print(f"Reusing test {test_name}, its hunks are unchanged")
+                self.results[test_name] = test_code
+
+        return self.results.get(test_name)
+
+    def cancel(self, test):
+
+        job = self.jobs.pop(test["test-name"], None)
+
+        if job is None:
+            return
+
+        if isinstance(job, GenerationTask) and not self.live_tests(job):
+            job.cancel()
+            if job.run_id is not None:
+                session_journal.drop_run(job.run_id)
+
+        self.retire(job)
+
+        print(f"Cancelled test: {test['test-name']}")
+
+    def retire(self, job):
+
+        if job not in self.retired_jobs:
+            self.retired_jobs.append(job)
+
+    def job_stopped(self):
+
+        # finished is queued after the task's other signals, so by now
+        # nothing else will need the sender
+        if self.sender() in self.retired_jobs:
+            self.retired_jobs.remove(self.sender())
+
+    def cancel_all_except(self, tests):
+
+        keep = {test["test-name"] for test in tests}
+
+        for test_name in list(self.jobs):
+            if test_name not in keep:
+                self.cancel({"test-name": test_name})
+
+        for test_name in list(self.results):
+            if test_name not in keep:
+                del self.results[test_name]
+
+    def cancel_all(self):
+
+        self.cancel_all_except([])
+
+        session_journal.end_session(self.session_id)
+
+    @diagnosed("tests")
+    def run_submitted(self, thread_id, run_id):
+
+        tests = self.live_tests(self.sender())
+
+        if tests:
+            session_journal.record_run(
+                self.session_id, thread_id, run_id, tests, self.sender().backend.name
+            )
+
+    @diagnosed("tests")
+    def generation_finished(self, content):
+
+        tests = self.live_tests(self.sender())
+
+        if not tests:
+            return
+
+        self.retire(self.sender())
+
+        # queue workers hand back extracted code already
+        if self.sender().backend.extracts_code:
+            self.finish_test(tests[0], content)
+            return
+
+        if len(self.sender().tests) == 1:
+            chat_api_task = ChatAPITask(
+                self.client, content, tests[0]["test-name"], self.pair
+            )
+            chat_api_task.response_received.connect(self.chat_api_response_received)
+            chat_api_task.extraction_failed.connect(self.extraction_failed)
+            self.start_job(chat_api_task, tests)
+            return
+
+        # a large batch is extracted in several calls so that no call asks
+        # for more output than the model can return
+        batch_size = model_router.extraction_batch_size(len(tests))
+        for start in range(0, len(tests), batch_size):
+            batch = tests[start : start + batch_size]
+            chat_api_task = BatchChatAPITask(
+                self.client, content, [test["test-name"] for test in batch], self.pair
+            )
+            chat_api_task.response_received.connect(
+                self.batch_chat_api_response_received
+            )
+            chat_api_task.extraction_failed.connect(self.extraction_failed)
+            self.start_job(chat_api_task, batch)
+
+    @diagnosed("tests")
+    def generation_failed(self, error):
+
+        tests = self.live_tests(self.sender())
+
+        self.retire(self.sender())
+
+        if self.sender().run_id is not None:
+            session_journal.drop_run(self.sender().run_id)
+
+        for test in tests:
+            del self.jobs[test["test-name"]]
+
+            print(f"Failed to generate test {test['test-name']}: {error}")
+
+            self.test_failed.emit(test["test-name"], error)
+
+    @diagnosed("tests")
+    def extraction_failed(self, error):
+
+        tests = self.live_tests(self.sender())
+
+        self.retire(self.sender())
+
+        for test in tests:
+            del self.jobs[test["test-name"]]
+
+            print(f"Failed to extract test {test['test-name']}: {error}")
+
+            self.test_failed.emit(test["test-name"], error)
+
+    @diagnosed("tests")
+    def chat_api_response_received(self, chat_response):
+
+        tests = self.live_tests(self.sender())
+
+        if not tests:
+            return
+
+        self.retire(self.sender())
+
+        self.finish_test(tests[0], chat_response.choices[0].message.content)
+
+    @diagnosed("tests")
+    def batch_chat_api_response_received(self, chat_response):
+
+        tests = self.live_tests(self.sender())
+
+        if not tests:
+            return
+
+        self.retire(self.sender())
+
+        try:
+            content = json.loads(chat_response.choices[0].message.content)
+            generated = content["tests"]
+        except (ValueError, KeyError, TypeError):
+            generated = []
+
+        generated_code = {
+            entry.get("test-name"): entry.get("test-code")
+            for entry in generated
+            if isinstance(entry, dict)
+        }
+
+        missing = []
+        for test in tests:
+            test_code = generated_code.get(test["test-name"])
+            # fall back on the order the tests were asked for when the names
+            # came back slightly altered
+            if not test_code and len(generated) == len(self.sender().tests):
+                entry = generated[self.sender().tests.index(test)]
+                if isinstance(entry, dict):
+                    test_code = entry.get("test-code")
+            if test_code:
+                self.finish_test(test, test_code)
+            else:
+                del self.jobs[test["test-name"]]
+                missing.append(test)
+
+        for test in missing:
+            print(f"Test {test['test-name']} missing from batch, generating alone")
+            self.generate(test)
+
+    def finish_test(self, test, test_code):
+
+        test_name = test["test-name"]
+
+        del self.jobs[test_name]
+
+        self.results[test_name] = test_code
+
+        hunk_cache.store_test(self.pair_key, test, test_code)
+        session_journal.record_result(self.session_id, test_name, test_code)
+
+        self.test_generated.emit(test_name, test_code)
@@ -10,15 +10,30 @@ from PyQt6.QtWidgets import (
     QCheckBox,
 )
 from PyQt6.QtGui import QMovie
-from PyQt6.QtCore import Qt, QSize, pyqtSignal, QThread
+from PyQt6.QtCore import Qt, QSize, pyqtSignal
 import os
 import sys
 from openai import OpenAI
 import configparser
-import time
 import json
 
+from context_index import ContextSelectionTask
+from diagnostics import diagnosed
 from generatedTests_view import GeneratedTestsView
+from file_manager import FileManager
+from git_access import get_git_access
+from generation_backend import GenerationTask, create_backend, IDEAS_STAGE
+from hunks import format_hunks, hunk_cache, parse_hunks, relevant_fingerprints
+from model_router import count_changed_lines, model_router
+from prompts import build_ideas_prompt
+from run_poller import PooledTask
+from test_dedup import DEDUP_FILTER, DEDUP_OFF, find_duplicates, read_dedup_config
+from test_generator import (
+    TestGenerator,
+    estimate_test_tokens,
+    read_speculative_config,
+)
+from usage_stats import BUDGET_OK, usage_ledger
 
 
 class UnitTestView(QWidget):
@@ -30,8 +45,14 @@ class UnitTestView(QWidget):
 
         self.repo = repo
         self.selected_tests = []
+        self.test_generator = None
+        self.speculative_tests = []
+        self.speculative_token_cap = 0
+        self.speculative_usage_connected = False
 
         self.confirm_pressed = False
+        # set once the window is cancelled or closed and its files are deleted
+        self.cancelled = False
 
         for file_pair in file_pairs:
             print(f"Initial file: {file_pair[0]}, Test file: {file_pair[1]}")
@@ -60,24 +81,25 @@ class UnitTestView(QWidget):
 
         self.api_key = config["OPENAI"]["API_KEY"]
 
-        client = OpenAI(api_key=self.api_key)
+        self.file_manager = FileManager(OpenAI(api_key=self.api_key))
+
+        self.initial_file = None
+        self.test_file = None
+        # (path, uploaded file) of the supporting files picked for the pair
+        self.context_files = []
 
         try:
 
             self.initial_file_path = file_pairs[0][0]
             self.test_file_path = file_pairs[0][1]
+            self.pair = " - ".join(os.path.basename(path) for path in file_pairs[0])
+            self.pair_key = hunk_cache.pair_key(
+                self.initial_file_path, self.test_file_path
+            )
 
-            with open(self.initial_file_path, "rb") as f:
-                start_time = time.time()
-                self.initial_file = client.files.create(file=f, purpose="assistants")
-                end_time = time.time()
-                print(f"Initial file uploaded in {end_time - start_time} seconds")
-
-            with open(self.test_file_path, "rb") as f:
-                start_time = time.time()
-                self.test_file = client.files.create(file=f, purpose="assistants")
-                end_time = time.time()
-                print(f"Test file uploaded in {end_time - start_time} seconds")
+            self.initial_file, self.test_file = self.file_manager.upload(
+                [self.initial_file_path, self.test_file_path]
+            )
 
             print("Files uploaded successfully")
         except Exception as e:
@@ -97,6 +119,17 @@ class UnitTestView(QWidget):
         self.generate_button.setFixedWidth(400)
         self.layout.addWidget(self.generate_button)
 
+        # base classes, fixtures and interfaces the pair builds on, which the
+        # prompts refer to but neither file contains. They are picked off the
+        # GUI thread and ideas wait for them
+        self.generate_button.setEnabled(False)
+        self.generate_button.setText("Selecting Context Files...")
+        self.context_task = ContextSelectionTask(
+            repo, self.initial_file_path, self.test_file_path
+        )
+        self.context_task.context_selected.connect(self.context_selected)
+        self.context_task.start()
+
         self.cancel_button = QPushButton("Cancel")
         self.cancel_button.setFixedHeight(40)
         self.cancel_button.setFixedWidth(400)
@@ -135,48 +168,40 @@ class UnitTestView(QWidget):
 
         self.setLayout(self.layout)
 
-    def cancel_clicked(self):
-
-        self.delete_files()
+    @diagnosed("ideas")
+    def context_selected(self, context_file_paths):
 
-    def delete_files(self):
-        client = OpenAI(api_key=self.api_key)
+        # the window may have been cancelled while the files were picked
+        if self.cancelled:
+            return
 
         try:
+            self.context_files = list(
+                zip(context_file_paths, self.file_manager.upload(context_file_paths))
+            )
+        except Exception as e:
+            print(f"Failed to attach context files: {e}")
 
-            time.sleep(1)
-
-            files = client.files.list().data
+        self.generate_button.setText("Generate Unit Test Ideas")
+        self.generate_button.setEnabled(True)
 
-            if self.initial_file and any(
-                file.id == self.initial_file.id for file in files
-            ):
-                try:
+    def cancel_clicked(self):
 
-                    client.files.delete(self.initial_file.id)
-                    print(f"Deleted initial file: {self.initial_file.id}")
-                except Exception as e:
-                    if "Not Found" in str(e):
-                        print("Initial file already deleted")
-                    else:
-                        raise
-                self.initial_file = None
+        self.delete_files()
 
-            time.sleep(1)
+    def delete_files(self):
 
-            files = client.files.list().data
+        self.cancelled = True
 
-            if self.test_file and any(file.id == self.test_file.id for file in files):
-                try:
+        try:
 
-                    client.files.delete(self.test_file.id)
-                    print(f"Deleted test file: {self.test_file.id}")
-                except Exception as e:
-                    if "Not Found" in str(e):
-                        print("Test file already deleted")
-                    else:
-                        raise
-                self.test_file = None
+            self.file_manager.delete(
+                [file.id for file in [self.initial_file, self.test_file] if file]
+                + [file.id for _, file in self.context_files]
+            )
+            self.initial_file = None
+            self.test_file = None
+            self.context_files = []
 
         except Exception as e:
             QMessageBox.warning(
@@ -185,6 +210,7 @@ class UnitTestView(QWidget):
 
         self.close()
 
+    @diagnosed("ideas")
     def generate_unit_test_ideas_clicked(self):
 
         self.generate_button.hide()
@@ -196,38 +222,62 @@ class UnitTestView(QWidget):
 
         try:
 
-            changes = self.repo.git.diff(None, self.initial_file_path)
+            changes = get_git_access(self.repo).diff(self.initial_file_path)
 
             self.formatted_changes = self.format_changes(changes)
 
-            assistant = client.beta.assistants.retrieve("asst_XW9b1pA7W2aExEWEFnp69xVq")
-
-            thread = client.beta.threads.create()
-
-            message_content = f"""Here are sections of the code that have been modified in the current commit:
-
-    \\`\\`\\`
-    {self.formatted_changes}
-    \\`\\`\\`
-
-    Reference the {os.path.basename(self.initial_file_path)} and especially the {os.path.basename(self.test_file_path)} file to determine the NEW unit tests that need to be written to address the above code modifications. There is no minimum or maximum number of unit tests but for each one you must specify the name and provide a description. Make sure the suggested tests align correctly with the testing approach and examples already established."""
+            # ideas whose hunks are untouched since the last run are reused,
+            # only hunks that changed are sent for new ideas
+            self.hunks = parse_hunks(changes)
+            cached_ideas, previous_fingerprints = hunk_cache.cached_ideas(self.pair_key)
+            fingerprints = {hunk["fingerprint"] for hunk in self.hunks}
+            self.reused_ideas = [
+                idea
+                for idea in cached_ideas
+                if fingerprints.issuperset(idea["hunk-fingerprints"])
+            ]
+            self.changed_hunks = [
+                hunk
+                for hunk in self.hunks
+                if hunk["fingerprint"] not in previous_fingerprints
+            ]
+
+            if previous_fingerprints and not self.changed_hunks:
+                print("No hunks changed since the last run, reusing ideas")
+                self.display_ideas(self.reused_ideas)
+                return
+
+            if previous_fingerprints:
+                print(
+                    f"Reusing {len(self.reused_ideas)} ideas, requesting ideas "
+                    f"for {len(self.changed_hunks)} changed hunks"
+                )
+                ideas_changes = format_hunks(self.changed_hunks)
+            else:
+                ideas_changes = self.formatted_changes
 
-            thread_message = client.beta.threads.messages.create(
-                thread_id=thread.id,
-                role="user",
-                content=message_content,
-                file_ids=[self.initial_file.id, self.test_file.id],
+            message_content = build_ideas_prompt(
+                ideas_changes,
+                os.path.basename(self.initial_file_path),
+                os.path.basename(self.test_file_path),
             )
 
-            run = client.beta.threads.runs.create(
-                thread_id=thread.id, assistant_id=assistant.id
+            self.generation_task = GenerationTask(
+                create_backend(client, IDEAS_STAGE),
+                message_content,
+                [self.initial_file_path, self.test_file_path]
+                + [file_path for file_path, _ in self.context_files],
+                [self.initial_file.id, self.test_file.id]
+                + [file.id for _, file in self.context_files],
+                pair=self.pair,
+                route=model_router.route(
+                    IDEAS_STAGE, count_changed_lines(ideas_changes)
+                ),
             )
-
-            print(f"Run status after creation: {run.status}")
-
-            self.run_status_thread = RunStatusThread(client, thread.id, run.id)
-            self.run_status_thread.status_updated.connect(self.run_status_updated)
-            self.run_status_thread.start()
+            self.generation_task.status_updated.connect(self.run_status_updated)
+            self.generation_task.generation_finished.connect(self.generation_finished)
+            self.generation_task.generation_failed.connect(self.generation_failed)
+            self.generation_task.start()
 
         except Exception as e:
             QMessageBox.warning(
@@ -239,45 +289,62 @@ class UnitTestView(QWidget):
     def run_status_updated(self, status):
         print(f"Run status during polling: {status}")
 
-        if status not in ["queued", "in_progress", "cancelling"]:
+    @diagnosed("ideas")
+    def generation_finished(self, content):
 
-            client = OpenAI(api_key=self.api_key)
+        client = OpenAI(api_key=self.api_key)
 
-            if status == "completed":
-                messages = client.beta.threads.messages.list(
-                    thread_id=self.run_status_thread.thread_id
-                )
+        self.chat_api_task = ChatAPITask(client, content, self.pair)
+        self.chat_api_task.response_received.connect(self.chat_api_response_received)
+        self.chat_api_task.start()
 
-                last_message = None
-                for message in reversed(messages.data):
-                    if message.role == "assistant":
-                        last_message = message
-                        break
-
-                if last_message is not None:
-                    for content_block in last_message.content:
-                        pass
-
-                    self.chat_api_thread = ChatAPIThread(
-                        client, content_block.text.value
-                    )
-                    self.chat_api_thread.response_received.connect(
-                        self.chat_api_response_received
-                    )
-                    self.chat_api_thread.start()
-            else:
-                print(status)
+    def generation_failed(self, error):
 
+        self.loading_movie.stop()
+        self.loading_label.hide()
+
+        QMessageBox.warning(
+            self,
+            "Error",
+            f"An error occurred while generating unit test ideas: {error}",
+        )
+
+    @diagnosed("ideas")
     def chat_api_response_received(self, chat_response):
 
+        content = json.loads(chat_response.choices[0].message.content)
+
+        reused_names = {idea["test-name"] for idea in self.reused_ideas}
+
+        ideas = list(self.reused_ideas)
+        for test in content["tests"]:
+            if test["test-name"] in reused_names:
+                continue
+            test["hunk-fingerprints"] = relevant_fingerprints(test, self.changed_hunks)
+            ideas.append(test)
+
+        hunk_cache.store_ideas(self.pair_key, ideas, self.hunks)
+
+        self.display_ideas(ideas)
+
+    def display_ideas(self, tests):
+
         self.loading_movie.stop()
         self.loading_label.hide()
 
         self.unit_test_list.clear()
 
-        content = json.loads(chat_response.choices[0].message.content)
+        duplicates = {}
+        dedup = read_dedup_config()
+        if dedup["mode"] != DEDUP_OFF:
+            duplicates = find_duplicates(tests, self.test_file_path, dedup["threshold"])
 
-        for test in content["tests"]:
+        if dedup["mode"] == DEDUP_FILTER:
+            for test_name, (existing_name, score) in duplicates.items():
+                print(f"Dropping idea {test_name}, similar to {existing_name}")
+            tests = [test for test in tests if test["test-name"] not in duplicates]
+
+        for test in tests:
 
             widget = QWidget()
             layout = QVBoxLayout()
@@ -293,6 +360,15 @@ class UnitTestView(QWidget):
             label.setWordWrap(True)
             layout.addWidget(label)
 
+            if test["test-name"] in duplicates:
+                existing_name, score = duplicates[test["test-name"]]
+                duplicate_label = QLabel(
+                    f"Possible duplicate of existing test {existing_name} "
+                    f"({score:.0%} similar)"
+                )
+                duplicate_label.setStyleSheet("color: #d08000;")
+                layout.addWidget(duplicate_label)
+
             item = QListWidgetItem(self.unit_test_list)
             self.unit_test_list.setItemWidget(item, widget)
 
@@ -302,6 +378,82 @@ class UnitTestView(QWidget):
         self.unit_test_list.show()
         self.confirm_button.show()
 
+        # likely duplicates are left for the developer to pick explicitly
+        self.start_speculative_generation(
+            [test for test in tests if test["test-name"] not in duplicates]
+        )
+
+    def start_speculative_generation(self, tests):
+
+        enabled, max_tests, max_tokens = read_speculative_config()
+
+        if not enabled:
+            return
+
+        if usage_ledger.check_budget() != BUDGET_OK:
+            print("Skipping speculative generation, token budget is running low")
+            return
+
+        # ideas come back ranked, so the first few are the most likely picks
+        self.test_generator = TestGenerator(
+            OpenAI(api_key=self.api_key),
+            self.initial_file,
+            self.test_file,
+            self.formatted_changes,
+            self.initial_file_path,
+            self.test_file_path,
+            context_files=self.context_files,
+        )
+
+        # nothing is recorded until the first responses arrive, so the tests
+        # started up front are sized from estimates and the cap is then
+        # enforced against the tokens actually recorded for them
+        shared_tokens = self.test_generator.shared_tokens()
+        estimated_tokens = 0
+        for test in tests[:max_tests]:
+            test_tokens = shared_tokens + estimate_test_tokens(test)
+            if max_tokens and estimated_tokens + test_tokens > max_tokens:
+                print(
+                    f"Speculating on {len(self.speculative_tests)} tests, "
+                    f"the next would exceed {max_tokens} tokens"
+                )
+                break
+            estimated_tokens += test_tokens
+            self.speculative_tests.append(test)
+            self.test_generator.generate(test)
+
+        if max_tokens:
+            self.speculative_token_cap = max_tokens
+            if not self.speculative_usage_connected:
+                usage_ledger.usage_recorded.connect(self.speculative_usage_recorded)
+                self.speculative_usage_connected = True
+
+    def speculative_usage_recorded(self):
+
+        if self.confirm_pressed or self.test_generator is None:
+            return
+
+        spent_tokens = usage_ledger.tests_tokens(
+            self.test_generator.pair,
+            {test["test-name"] for test in self.speculative_tests},
+        )
+
+        if spent_tokens < self.speculative_token_cap:
+            return
+
+        pending_tests = [
+            test
+            for test in self.speculative_tests
+            if self.test_generator.is_pending(test)
+        ]
+        if pending_tests:
+            print(
+                f"Speculative generation used {spent_tokens} tokens, cancelling "
+                f"{len(pending_tests)} tests"
+            )
+        for test in pending_tests:
+            self.test_generator.cancel(test)
+
     def handle_checkbox_state_changed(self, state, test):
 
         if state == 2:
@@ -325,10 +477,18 @@ class UnitTestView(QWidget):
 
     def closeEvent(self, event):
 
+        # the ledger outlives the window, which must stop listening to it
+        if self.speculative_usage_connected:
+            usage_ledger.usage_recorded.disconnect(self.speculative_usage_recorded)
+            self.speculative_usage_connected = False
+
         if not self.confirm_pressed:
+            if self.test_generator is not None:
+                self.test_generator.cancel_all()
             self.delete_files()
         event.accept()
 
+    @diagnosed("tests")
     def confirm_selection(self):
 
         if not self.selected_tests:
@@ -341,53 +501,38 @@ class UnitTestView(QWidget):
 
         self.tests_confirmed.emit(self.selected_tests)
 
+        if self.test_generator is not None:
+            self.test_generator.cancel_all_except(self.selected_tests)
+
         self.generated_tests_view = GeneratedTestsView(
             self.selected_tests,
             self.initial_file,
             self.test_file,
             self.formatted_changes,
-            os.path.basename(self.test_file_path),
+            self.initial_file_path,
+            self.test_file_path,
+            self.test_generator,
+            self.context_files,
         )
         self.generated_tests_view.show()
 
         self.close()
 
 
-class RunStatusThread(QThread):
-    status_updated = pyqtSignal(str)
-
-    def __init__(self, client, thread_id, run_id):
-        super().__init__()
-        self.client = client
-        self.thread_id = thread_id
-        self.run_id = run_id
-
-    def run(self):
-        delay = 1
-        run = self.client.beta.threads.runs.retrieve(
-            thread_id=self.thread_id, run_id=self.run_id
-        )
-        while run.status in ["queued", "in_progress", "cancelling"]:
-            time.sleep(delay)
-            run = self.client.beta.threads.runs.retrieve(
-                thread_id=self.thread_id, run_id=self.run_id
-            )
-            self.status_updated.emit(run.status)
-            delay = min(delay * 2, 15)
-
-
-class ChatAPIThread(QThread):
+class ChatAPITask(PooledTask):
     response_received = pyqtSignal(object)
 
-    def __init__(self, client, content):
+    def __init__(self, client, content, pair=None):
         super().__init__()
         self.client = client
         self.content = content
+        self.pair = pair
 
     def run(self):
-        chat_response = self.client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
+        chat_response = model_router.create_chat_completion(
+            self.client,
+            model_router.extraction_route(),
+            [
                 {
                     "role": "system",
                     "content": "You need to find the test name and test description for each unit test described in a section of content and return them in a JSON format.",
@@ -397,8 +542,7 @@ class ChatAPIThread(QThread):
                     "content": f"return json format for the following information with fields tests, test-name and test-description:\n\n{self.content}",
                 },
             ],
-            temperature=1,
-            max_tokens=1000,
             response_format={"type": "json_object"},
         )
+        usage_ledger.record("ideas extraction", chat_response.usage, pair=self.pair)
         self.response_received.emit(chat_response)
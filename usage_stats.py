@@ -0,0 +1,204 @@
+import configparser
+import datetime
+import sqlite3
+import threading
+
+from PyQt6.QtCore import QObject, pyqtSignal
+
+
+USAGE_FILE = "usage.db"
+
+BUDGET_OK = "ok"
+BUDGET_THROTTLE = "throttle"
+BUDGET_STOP = "stop"
+
+DEFAULT_THROTTLE_AT = 0.8
+DEFAULT_THROTTLE_SECONDS = 10
+
+
+def read_budget_config():
+
+    config = configparser.ConfigParser()
+
+    config.read("config.ini")
+
+    section = config["BUDGET"] if "BUDGET" in config else {}
+
+    return {
+        "session_tokens": int(section.get("SESSION_TOKENS", 0)),
+        "daily_tokens": int(section.get("DAILY_TOKENS", 0)),
+        "throttle_at": float(section.get("THROTTLE_AT", DEFAULT_THROTTLE_AT)),
+        "throttle_seconds": int(
+            section.get("THROTTLE_SECONDS", DEFAULT_THROTTLE_SECONDS)
+        ),
+    }
+
+
+def cached_prompt_tokens(usage):
+
+    details = getattr(usage, "prompt_tokens_details", None)
+
+    if details is None:
+        return 0
+
+    return getattr(details, "cached_tokens", 0) or 0
+
+
+class UsageLedger(QObject):
+
+    usage_recorded = pyqtSignal()
+
+    def __init__(self, usage_path=USAGE_FILE):
+        super().__init__()
+
+        self.usage_path = usage_path
+        self.lock = threading.Lock()
+        self.connection = None
+
+        # one entry per call: stage, test name, pair and token counts
+        self.entries = []
+
+    def connect(self):
+
+        if self.connection is not None:
+            return self.connection
+
+        # other instances and queue workers add to the same daily total, so
+        # it lives in SQLite rather than in a file each process overwrites
+        self.connection = sqlite3.connect(
+            self.usage_path, check_same_thread=False, timeout=30
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS daily (date TEXT PRIMARY KEY, tokens INTEGER)"
+        )
+
+        return self.connection
+
+    def add_daily(self, tokens):
+
+        try:
+            connection = self.connect()
+            with connection:
+                connection.execute(
+                    "INSERT INTO daily VALUES (?, ?) ON CONFLICT (date) "
+                    "DO UPDATE SET tokens = tokens + excluded.tokens",
+                    (datetime.date.today().isoformat(), tokens),
+                )
+        except sqlite3.Error as e:
+            print(f"Failed to save token usage: {e}")
+
+    def record(self, stage, usage, test_name=None, pair=None):
+
+        if usage is None:
+            return
+
+        entry = {
+            "stage": stage,
+            "test": test_name,
+            "pair": pair,
+            "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+            "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+            "cached_tokens": cached_prompt_tokens(usage),
+        }
+
+        with self.lock:
+            self.entries.append(entry)
+            self.add_daily(entry["prompt_tokens"] + entry["completion_tokens"])
+
+        print(
+            f"{stage}: {entry['prompt_tokens']} prompt tokens "
+            f"({entry['cached_tokens']} cached), "
+            f"{entry['completion_tokens']} completion tokens, "
+            f"{self.hit_rate(stage):.0%} cache hit rate this session"
+        )
+
+        self.usage_recorded.emit()
+
+    def totals(self, key=None, value=None):
+
+        totals = {"prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0}
+
+        with self.lock:
+            for entry in self.entries:
+                if key is not None and entry[key] != value:
+                    continue
+                for field in totals:
+                    totals[field] += entry[field]
+
+        return totals
+
+    def tests_tokens(self, pair, test_names):
+
+        # every stage spent on the given tests of a pair, extraction included
+        with self.lock:
+            return sum(
+                entry["prompt_tokens"] + entry["completion_tokens"]
+                for entry in self.entries
+                if entry["pair"] == pair and entry["test"] in test_names
+            )
+
+    def hit_rate(self, stage):
+
+        totals = self.totals("stage", stage)
+
+        if not totals["prompt_tokens"]:
+            return 0.0
+
+        return totals["cached_tokens"] / totals["prompt_tokens"]
+
+    def session_tokens(self):
+
+        totals = self.totals()
+
+        return totals["prompt_tokens"] + totals["completion_tokens"]
+
+    def daily_tokens(self):
+
+        with self.lock:
+            try:
+                row = (
+                    self.connect()
+                    .execute(
+                        "SELECT tokens FROM daily WHERE date = ?",
+                        (datetime.date.today().isoformat(),),
+                    )
+                    .fetchone()
+                )
+            except sqlite3.Error as e:
+                print(f"Failed to read token usage: {e}")
+                return 0
+
+        return row[0] if row else 0
+
+    def check_budget(self):
+
+        budget = read_budget_config()
+
+        usage_fraction = 0.0
+        for used, limit in [
+            (self.session_tokens(), budget["session_tokens"]),
+            (self.daily_tokens(), budget["daily_tokens"]),
+        ]:
+            if limit:
+                usage_fraction = max(usage_fraction, used / limit)
+
+        if usage_fraction >= 1:
+            return BUDGET_STOP
+        if usage_fraction >= budget["throttle_at"]:
+            return BUDGET_THROTTLE
+        return BUDGET_OK
+
+    def summary(self):
+
+        totals = self.totals()
+
+        return (
+            f"Tokens this session: {totals['prompt_tokens']} prompt "
+            f"({totals['cached_tokens']} cached), "
+            f"{totals['completion_tokens']} completion. "
+            f"Today: {self.daily_tokens()}"
+        )
+
+
+usage_ledger = UsageLedger()
@@ -0,0 +1,201 @@
+import argparse
+import configparser
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from openai import OpenAI
+
+from file_manager import FileManager
+from generation_backend import create_backend, TESTS_STAGE
+from job_queue import JobQueue, read_queue_config, worker_name
+from model_router import count_changed_lines, model_router
+from test_generator import extract_test_code
+from usage_stats import (
+    BUDGET_STOP,
+    BUDGET_THROTTLE,
+    read_budget_config,
+    usage_ledger,
+)
+
+
+IDLE_SLEEP_SECONDS = 5
+
+
+class Worker:
+    def __init__(self, client, job_queue, backend, lease_seconds, owner):
+        self.client = client
+        self.job_queue = job_queue
+        self.backend = backend
+        self.lease_seconds = lease_seconds
+        self.owner = owner
+        self.file_manager = FileManager(client)
+
+    def keep_lease(self, job_id, done, lost):
+
+        while not done.wait(self.lease_seconds / 3):
+            if not self.job_queue.renew(job_id, self.owner, self.lease_seconds):
+                # the job was cancelled or taken over, so its result is unwanted
+                print(f"Lost the lease on job {job_id}")
+                lost.set()
+                return
+
+    def run_job(self, job):
+
+        test_name = (job["test"] or {}).get("test-name", f"job {job['id']}")
+
+        print(f"{self.owner} generating {test_name} for {job['pair']}")
+
+        done = threading.Event()
+        lost = threading.Event()
+        threading.Thread(
+            target=self.keep_lease, args=(job["id"], done, lost), daemon=True
+        ).start()
+
+        directory = tempfile.mkdtemp(prefix="unit-test-job-")
+        file_ids = []
+
+        try:
+            file_paths = []
+            for file in job["files"]:
+                file_path = os.path.join(directory, file["name"])
+                with open(file_path, "w", encoding="utf-8") as f:
+                    f.write(file["content"])
+                file_paths.append(file_path)
+
+            if self.backend.polls_runs:
+                file_ids = [
+                    uploaded_file.id
+                    for uploaded_file in self.file_manager.upload(file_paths)
+                ]
+
+            route = model_router.route(
+                TESTS_STAGE,
+                count_changed_lines(job["prompt"]),
+                [job["test"]] if job["test"] else [],
+            )
+
+            content, usage = self.backend.generate(
+                job["prompt"],
+                file_paths,
+                file_ids,
+                should_stop=lost.is_set,
+                route=route,
+            )
+            usage_ledger.record(self.backend.stage, usage, test_name, job["pair"])
+
+            chat_response = extract_test_code(
+                self.client, content, test_name, job["pair"]
+            )
+
+            if self.job_queue.complete(
+                job["id"], self.owner, chat_response.choices[0].message.content
+            ):
+                print(f"Finished job {job['id']}")
+            else:
+                print(f"Discarded the result of job {job['id']}")
+
+        except Exception as e:
+            print(f"Job {job['id']} failed: {e}")
+            self.job_queue.fail(job["id"], self.owner, str(e))
+
+        finally:
+            done.set()
+            if file_ids:
+                try:
+                    self.file_manager.delete(file_ids)
+                except Exception as e:
+                    print(f"Failed to delete files of job {job['id']}: {e}")
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def work(self, drain):
+
+        while True:
+            # workers spend from the same session and daily budgets as the app
+            budget = usage_ledger.check_budget()
+
+            if budget == BUDGET_STOP:
+                print(f"{self.owner} stopping, the token budget is used up")
+                return
+
+            if budget == BUDGET_THROTTLE:
+                print(f"{self.owner} throttling, the token budget is running low")
+                time.sleep(read_budget_config()["throttle_seconds"])
+
+            job = self.job_queue.claim(self.owner, self.lease_seconds)
+
+            if job is None:
+                if drain:
+                    return
+                time.sleep(IDLE_SLEEP_SECONDS)
+                continue
+
+            self.run_job(job)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Run queued test generation jobs")
+    parser.add_argument("--queue", help="path of the job queue database")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument(
+        "--drain", action="store_true", help="exit once the queue is empty"
+    )
+    parser.add_argument(
+        "--status", action="store_true", help="print job counts and exit"
+    )
+    args = parser.parse_args()
+
+    queue_config = read_queue_config()
+
+    job_queue = JobQueue(
+        args.queue or queue_config["path"],
+        queue_config["max_attempts"],
+        queue_config["shared"],
+    )
+
+    if args.status:
+        for status, count in sorted(job_queue.counts().items()):
+            print(f"{status}: {count}")
+        return
+
+    config = configparser.ConfigParser()
+
+    config.read("config.ini")
+
+    api_key = os.environ.get("OPENAI_API_KEY")
+    if "OPENAI" in config and "API_KEY" in config["OPENAI"]:
+        api_key = config["OPENAI"]["API_KEY"]
+
+    if not api_key:
+        sys.exit("No OpenAI API key in config.ini or OPENAI_API_KEY")
+
+    if queue_config["worker_backend"] == "queue":
+        sys.exit("WORKER_BACKEND must be assistants or chat")
+
+    client = OpenAI(api_key=api_key)
+
+    backend = create_backend(client, TESTS_STAGE, queue_config["worker_backend"])
+
+    threads = []
+    for index in range(args.concurrency):
+        worker = Worker(
+            client,
+            job_queue,
+            backend,
+            queue_config["lease_seconds"],
+            f"{worker_name()}-{index}",
+        )
+        thread = threading.Thread(target=worker.work, args=(args.drain,))
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+
+if __name__ == "__main__":
+    main()